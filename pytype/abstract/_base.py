@@ -28,6 +28,10 @@ class BaseValue(utils.ContextWeakrefMixin):
   """
 
   formal = False  # is this type non-instantiable?
+  # Whether this is an Unknown, Unsolvable or Empty, i.e. an instance of
+  # abstract.AMBIGUOUS_OR_EMPTY. A class attribute is cheaper to check than
+  # isinstance() against the tuple.
+  is_ambiguous_or_empty = False
 
   def __init__(self, name, ctx):
     """Basic initializer for all BaseValues."""
@@ -30,6 +30,7 @@ class Unknown(_base.BaseValue):
 
   # For simplicity, Unknown doesn't emulate descriptors:
   IGNORED_ATTRIBUTES = ["__get__", "__set__", "__getattribute__"]
+  is_ambiguous_or_empty = True
 
   def __init__(self, ctx):
     name = escape.unknown(Unknown._current_id)
@@ -202,6 +203,8 @@ class Empty(Singleton):
   convert.Converter._function_to_def and tracer_vm.CallTracer.pytd_for_types.
   """
 
+  is_ambiguous_or_empty = True
+
   def __init__(self, ctx):
     super().__init__("empty", ctx)
 
@@ -230,6 +233,7 @@ class Unsolvable(Singleton):
   only need one.
   """
   IGNORED_ATTRIBUTES = ["__get__", "__set__", "__getattribute__"]
+  is_ambiguous_or_empty = True
 
   # Since an unsolvable gets generated e.g. for every unresolved import, we
   # can have multiple circular Unsolvables in a class' MRO. Treat those special.
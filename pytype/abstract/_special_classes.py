@@ -4,6 +4,10 @@ from pytype.abstract import class_mixin
 from pytype.pytd import pytd
 
 
+_TYPED_DICT_NAMES = frozenset(
+    ("typing.TypedDict", "typing_extensions.TypedDict"))
+
+
 class _Builder:
   """Build special classes created by inheriting from a specific class."""
 
@@ -43,20 +47,24 @@ class _Builder:
 class _TypedDictBuilder(_Builder):
   """Build a typed dict."""
 
-  CLASSES = ("typing.TypedDict", "typing_extensions.TypedDict")
-
   def matches_class(self, c):
-    return c.name in self.CLASSES
+    return c.name in _TYPED_DICT_NAMES
 
   def matches_base(self, c):
-    return any(isinstance(b, pytd.ClassType) and self.matches_class(b)
-               for b in c.bases)
+    for b in c.bases:
+      # pytd.ClassType has no subclasses, so an exact type check suffices.
+      if (type(b) is pytd.ClassType and  # pylint: disable=unidiomatic-typecheck
+          b.name in _TYPED_DICT_NAMES):
+        return True
+    return False
 
   def matches_mro(self, c):
     # Check if we have typed dicts in the MRO by seeing if we have already
     # created a TypedDictClass for one of the ancestor classes.
-    return any(isinstance(b, class_mixin.Class) and b.is_typed_dict_class
-               for b in c.mro)
+    for b in c.mro:
+      if isinstance(b, class_mixin.Class) and b.is_typed_dict_class:
+        return True
+    return False
 
   def make_base_class(self):
     return self.convert.make_typed_dict_builder(self.ctx)
@@ -68,10 +76,17 @@ class _TypedDictBuilder(_Builder):
 _BUILDERS = (_TypedDictBuilder,)
 
 
+def _get_builders(ctx):
+  """Get the builders for ctx, creating them on first use."""
+  if ctx.special_class_builders is None:
+    ctx.special_class_builders = tuple(b(ctx) for b in _BUILDERS)
+  return ctx.special_class_builders
+
+
 def maybe_build_from_pytd(name, pytd_cls, ctx):
   """Try to build a special class from a pytd class."""
-  for b in _BUILDERS:
-    ret = b(ctx).maybe_build_from_pytd(name, pytd_cls)
+  for b in _get_builders(ctx):
+    ret = b.maybe_build_from_pytd(name, pytd_cls)
     if ret:
       return ret
   return None
@@ -79,8 +94,8 @@ def maybe_build_from_pytd(name, pytd_cls, ctx):
 
 def maybe_build_from_mro(abstract_cls, name, pytd_cls, ctx):
   """Try to build a special class from the MRO of an abstract class."""
-  for b in _BUILDERS:
-    ret = b(ctx).maybe_build_from_mro(abstract_cls, name, pytd_cls)
+  for b in _get_builders(ctx):
+    ret = b.maybe_build_from_mro(abstract_cls, name, pytd_cls)
     if ret:
       return ret
   return None
@@ -1049,6 +1049,14 @@ class AbstractTest(AbstractTestBase):
     cls.update_official_name("A")  # no effect
     self.assertEqual(cls.official_name, "X")
 
+  def test_is_ambiguous_or_empty(self):
+    for value in (abstract.Unknown(self._ctx), self._ctx.convert.unsolvable,
+                  self._ctx.convert.empty):
+      self.assertTrue(value.is_ambiguous_or_empty)
+    for value in (self._ctx.convert.none, self._ctx.convert.int_type,
+                  abstract.TypeParameter("T", self._ctx)):
+      self.assertFalse(value.is_ambiguous_or_empty)
+
   def test_type_parameter_official_name(self):
     param = abstract.TypeParameter("T", self._ctx)
     self._ctx.vm.frame = frame_state.SimpleFrame()  # for error logging
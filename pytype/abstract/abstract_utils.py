@@ -609,14 +609,23 @@ def is_callable(value: _BaseValue):
 
 def expand_type_parameter_instances(bindings: Iterable[cfg.Binding]):
   bindings = list(bindings)
-  while bindings:
-    b = bindings.pop(0)
-    if _isinstance(b.data, "TypeParameterInstance"):
-      param_value = b.data.instance.get_instance_type_parameter(b.data.name)
-      if param_value.bindings:
-        bindings = param_value.bindings + bindings
-        continue
-    yield b
+  if not any(_isinstance(b.data, "TypeParameterInstance") for b in bindings):
+    # The common case: nothing to expand.
+    yield from bindings
+    return
+  # A stack of iterators over snapshots of the bindings, since callers may add
+  # bindings to the variables while consuming this generator.
+  stack = [iter(bindings)]
+  while stack:
+    for b in stack[-1]:
+      if _isinstance(b.data, "TypeParameterInstance"):
+        param_value = b.data.instance.get_instance_type_parameter(b.data.name)
+        if param_value.bindings:
+          stack.append(iter(list(param_value.bindings)))
+          break
+      yield b
+    else:
+      stack.pop()
 
 
 def get_type_parameter_substitutions(
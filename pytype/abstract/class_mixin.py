@@ -189,7 +189,7 @@ class Class(metaclass=mixin.MixinMeta):  # pylint: disable=undefined-variable
       self.protocol_attributes = self.base_cls.protocol_attributes
       return
     if not self.has_protocol_base():
-      self.protocol_attributes = set()
+      self.protocol_attributes = frozenset()
       return
     if (_isinstance(self, "PyTDClass") and
         self.pytd_cls.name.startswith("typing.")):
@@ -204,7 +204,7 @@ class Class(metaclass=mixin.MixinMeta):  # pylint: disable=undefined-variable
       # Sequence, which contains a mix of abstract and non-abstract methods, as
       # protocols, with only the abstract methods being required.
       protocol_attributes |= self.abstract_methods
-      self.protocol_attributes = protocol_attributes
+      self.protocol_attributes = frozenset(protocol_attributes)
       return
     # For the algorithm to run, protocol_attributes needs to be populated with
     # the protocol attributes defined by this class. We'll overwrite the
@@ -220,7 +220,7 @@ class Class(metaclass=mixin.MixinMeta):  # pylint: disable=undefined-variable
       else:
         # Remove attributes implemented by this class.
         protocol_attributes = {a for a in protocol_attributes if a not in cls}
-    self.protocol_attributes = protocol_attributes
+    self.protocol_attributes = frozenset(protocol_attributes)
 
   def _init_overrides_bool(self):
     """Compute and cache whether the class sets its own boolean value."""
@@ -380,13 +380,11 @@ class Args(collections.namedtuple(
       An Args instance.
     """
     assert isinstance(posargs, tuple), posargs
-    cls.replace = cls._replace
-    return super().__new__(
-        cls,
-        posargs=posargs,
-        namedargs=namedargs or {},
-        starargs=starargs,
-        starstarargs=starstarargs)
+    return super().__new__(cls, posargs, namedargs or {}, starargs,
+                           starstarargs)
+
+  def replace(self, **kwargs):
+    return self._replace(**kwargs)
 
   def has_namedargs(self):
     if isinstance(self.namedargs, dict):
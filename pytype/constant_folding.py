@@ -21,9 +21,15 @@ For ease of testing and debugging there is also a simplified literal syntax to
 construct and examine these typestructs, see constant_folding_test for examples.
 This is less uniform, and therefore not recommended to use other than for
 input/output.
+
+Folding is done on bytecode rather than on an AST because pytype never sees the
+AST of the code it analyzes: source is compiled by the target version's
+interpreter (see pyc.compile_src) and only the resulting code objects are
+loaded back.
 """
 
-from typing import Any, Dict, FrozenSet, Tuple
+import itertools
+from typing import Any, Dict, FrozenSet, Optional, Tuple, Union
 
 import attr
 
@@ -40,6 +46,25 @@ from pytype.pyc import pyc
 MAX_VAR_SIZE = 64
 
 
+# Opcodes that build a literal out of the values on the stack. Without one of
+# these there is nothing to fold.
+_BUILD_OPCODES = frozenset({
+    opcodes.BUILD_LIST, opcodes.BUILD_SET, opcodes.FORMAT_VALUE,
+    opcodes.BUILD_STRING, opcodes.BUILD_MAP, opcodes.BUILD_CONST_KEY_MAP})
+
+
+# Interned ('prim', <python type>) typestructs.
+_PRIM_TYPESTRUCTS = {}
+
+
+def _prim(python_type):
+  """Get the (interned) typestruct for a primitive type."""
+  typ = _PRIM_TYPESTRUCTS.get(python_type)
+  if typ is None:
+    typ = _PRIM_TYPESTRUCTS[python_type] = ('prim', python_type)
+  return typ
+
+
 class ConstantError(Exception):
   """Errors raised during constant folding."""
 
@@ -69,12 +94,13 @@ class ConstantError(Exception):
 #  construct 'typ' and 'elements' at the end, that would mean recursively
 #  unfolding a structure that we have just folded; the code is simpler if we
 #  track elements and types at every stage.
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True)
 class _Constant:
   """A folded python constant."""
   typ: Tuple[str, Any]
   value: Any
-  elements: Any
+  # None for primitives, a tuple for linear collections, a dict for maps.
+  elements: Optional[Union[Tuple[Any, ...], Dict[Any, Any]]]
   op: opcodes.Opcode
 
   @property
@@ -82,100 +108,75 @@ class _Constant:
     return self.typ[0]
 
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True)
 class _Collection:
   """A linear collection (e.g. list, tuple, set)."""
   types: FrozenSet[Any]
-  values: Tuple[Any, ...]
-  elements: Tuple[Any, ...]
+  elements: Tuple[_Constant, ...]
 
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True)
 class _Map:
   """A dictionary."""
   key_types: FrozenSet[Any]
-  keys: Tuple[Any, ...]
   value_types: FrozenSet[Any]
-  values: Tuple[Any, ...]
-  elements: Dict[Any, Any]
-
-
-class _CollectionBuilder:
-  """Build up a collection of constants."""
-
-  def __init__(self):
-    self.types = set()
-    self.values = []
-    self.elements = []
-
-  def add(self, constant):
-    self.types.add(constant.typ)
-    self.elements.append(constant)
-    self.values.append(constant.value)
-
-  def build(self):
-    return _Collection(
-        types=frozenset(self.types),
-        values=tuple(reversed(self.values)),
-        elements=tuple(reversed(self.elements)))
-
-
-class _MapBuilder:
-  """Build up a map of constants."""
-
-  def __init__(self):
-    self.key_types = set()
-    self.value_types = set()
-    self.keys = []
-    self.values = []
-    self.elements = {}
-
-  def add(self, key, value):
-    self.key_types.add(key.typ)
-    self.value_types.add(value.typ)
-    self.keys.append(key.value)
-    self.values.append(value.value)
-    self.elements[key.value] = value
-
-  def build(self):
-    return _Map(
-        key_types=frozenset(self.key_types),
-        keys=tuple(reversed(self.keys)),
-        value_types=frozenset(self.value_types),
-        values=tuple(reversed(self.values)),
-        elements=self.elements)
+  elements: Dict[Any, _Constant]
 
 
 class _Stack:
   """A simple opcode stack."""
 
-  def __init__(self):
+  def __init__(self, typestructs):
     self.stack = []
     self.consts = {}
+    self.typestructs = typestructs
+    # Index of the topmost None (non-constant) entry in the stack, or -1.
+    self._last_none_at = -1
+
+  def intern(self, typ):
+    """Hash-cons a typestruct, so that equal typestructs share one object.
+
+    Unions (frozensets of typestructs) are interned through the same table.
+    """
+    return self.typestructs.setdefault(typ, typ)
 
   def __iter__(self):
     return self.stack.__iter__()
 
   def push(self, val):
+    if val is None:
+      self._last_none_at = len(self.stack)
     self.stack.append(val)
 
   def pop(self):
-    return self.stack.pop()
+    val = self.stack.pop()
+    if self._last_none_at == len(self.stack):
+      self._find_last_none()
+    return val
+
+  def _find_last_none(self):
+    for i in range(len(self.stack) - 1, -1, -1):
+      if self.stack[i] is None:
+        self._last_none_at = i
+        return
+    self._last_none_at = -1
 
   def _preserve_constant(self, c):
-    if c and (
-        not isinstance(c.op, opcodes.LOAD_CONST) or
-        isinstance(c.op, opcodes.BUILD_STRING)):
+    # Plain LOAD_CONST ops do not need to be replaced by a folded constant.
+    if c and c.op.__class__ is not opcodes.LOAD_CONST:
       self.consts[id(c.op)] = c
 
   def clear(self):
     # Preserve any constants in the stack before clearing it.
+    consts = self.consts
     for c in self.stack:
-      self._preserve_constant(c)
+      if c and c.op.__class__ is not opcodes.LOAD_CONST:
+        consts[id(c.op)] = c
     self.stack = []
+    self._last_none_at = -1
 
   def _pop_args(self, n):
-    """Try to get n args off the stack for a BUILD call."""
+    """Try to get n args, in the order they were pushed, for a BUILD call."""
     # TODO(b/175443170): Handle the case of n = 0 - we currently back out of
     # folding a constant that contains an empty list/map/fstring as an element.
     if len(self.stack) < n:
@@ -184,47 +185,57 @@ class _Stack:
       # literal is not constant.
       self.clear()
       return None
-    elif any(x is None for x in self.stack[-n:]):
+    start = len(self.stack) - n
+    if self._last_none_at >= start:
       # We have something other than constants in the arg list. Pop all the args
       # for this op off the stack, preserving constants.
       for _ in range(n):
         self._preserve_constant(self.pop())
       return None
     else:
-      return [self.pop() for _ in range(n)]
+      args = self.stack[start:]
+      del self.stack[start:]
+      return args
 
   def fold_args(self, n, op):
     """Collect the arguments to a build call."""
-    ret = _CollectionBuilder()
     args = self._pop_args(n)
     if not args:
       self.push(None)
       return None
 
+    types = set()
     for elt in args:
-      ret.add(elt)
+      types.add(elt.typ)
       elt.op.folded = op
-    return ret.build()
+    return _Collection(
+        types=self.intern(frozenset(types)), elements=tuple(args))
 
   def fold_map_args(self, n, op):
     """Collect the arguments to a BUILD_MAP call."""
-    ret = _MapBuilder()
     args = self._pop_args(2 * n)
     if not args:
       self.push(None)
       return None
 
+    key_types = set()
+    value_types = set()
+    elements = {}
     for i in range(0, 2 * n, 2):
-      v_elt, k_elt = args[i], args[i + 1]
-      ret.add(k_elt, v_elt)
+      k_elt, v_elt = args[i], args[i + 1]
+      key_types.add(k_elt.typ)
+      value_types.add(v_elt.typ)
+      elements[k_elt.value] = v_elt
       k_elt.op.folded = op
       v_elt.op.folded = op
-    return ret.build()
+    return _Map(
+        key_types=self.intern(frozenset(key_types)),
+        value_types=self.intern(frozenset(value_types)), elements=elements)
 
   def build_str(self, n, op):
     ret = self.fold_args(n, op)
     if ret:
-      self.push(_Constant(('prim', str), '', None, op))
+      self.push(_Constant(_prim(str), '', None, op))
     else:
       self.push(None)
     return ret
@@ -234,84 +245,142 @@ class _Stack:
     collection = self.fold_args(op.arg, op)
     if collection:
       typename = python_type.__name__
-      typ = (typename, collection.types)
+      typ = self.intern((typename, collection.types))
       try:
-        value = python_type(collection.values)
+        value = python_type(e.value for e in collection.elements)
       except TypeError as e:
         raise ConstantError(f'TypeError: {e.args[0]}', op) from e
       elements = collection.elements
       self.push(_Constant(typ, value, elements, op))
 
 
-class _FoldedOps:
-  """Mapping from a folded opcode to the top level constant that replaces it."""
+def _resolve_folded(op):
+  """Follow the `folded` chain of an opcode to the op that replaces it."""
+  f = op
+  while f.folded:
+    f = f.folded
+  # Compress the path so that later lookups reach the final op in one step.
+  while op.folded and op.folded is not f:
+    op.folded, op = f, op.folded
+  return f
 
-  def __init__(self):
-    self.folds = {}
 
-  def add(self, op):
-    self.folds[id(op)] = op.folded
+class _FoldConstants:
+  """Fold constant literals in pyc code."""
+
+  def __init__(self):
+    # Typestructs are hash-consed across all the code objects we visit, so that
+    # equal typestructs are represented by the same object.
+    self._typestructs = {}
+    # Tuple constants are often repeated (e.g. argument name tuples), so we
+    # memoize their typestructs by object id. The memo is reset for every code
+    # object, whose co_consts keep the tuples alive.
+    self._tuple_typestructs = {}
+    # Handlers for the opcodes that take part in building a literal constant,
+    # keyed by the exact opcode class.
+    self._handlers = {
+        opcodes.LOAD_CONST: self._load_const,
+        opcodes.BUILD_LIST: self._build_list,
+        opcodes.BUILD_SET: self._build_set,
+        opcodes.FORMAT_VALUE: self._format_value,
+        opcodes.BUILD_STRING: self._build_string,
+        opcodes.BUILD_MAP: self._build_map,
+        opcodes.BUILD_CONST_KEY_MAP: self._build_const_key_map,
+    }
+
+  def _build_tuple(self, tup):
+    """Get the typestruct for a tuple constant."""
+    typ = self._tuple_typestructs.get(id(tup))
+    if typ is None:
+      elt_types = {type(e) for e in tup}
+      if len(elt_types) == 1 and tuple not in elt_types:
+        # Fast path for homogeneous tuples of primitives, e.g. names.
+        typ = ('tuple', (_prim(elt_types.pop()),) * len(tup))
+      else:
+        out = []
+        for e in tup:
+          if isinstance(e, tuple):
+            out.append(self._build_tuple(e))
+          else:
+            out.append(_prim(type(e)))
+        typ = ('tuple', tuple(out))
+      typ = self._typestructs.setdefault(typ, typ)
+      self._tuple_typestructs[id(tup)] = typ
+    return typ
+
+  def _load_const(self, stack, op, code):
+    elt = code.co_consts[op.arg]
+    if isinstance(elt, tuple):
+      typ = self._build_tuple(elt)
+      stack.push(_Constant(typ, elt, typ[1], op))
+    else:
+      stack.push(_Constant(_prim(type(elt)), elt, None, op))
 
-  def resolve(self, op):
-    f = op
-    while id(f) in self.folds:
-      f = self.folds[id(f)]
-    return f
+  def _build_list(self, stack, op, code):
+    del code  # unused
+    stack.build(list, op)
 
+  def _build_set(self, stack, op, code):
+    del code  # unused
+    stack.build(set, op)
 
-class _FoldConstants:
-  """Fold constant literals in pyc code."""
+  def _format_value(self, stack, op, code):
+    del code  # unused
+    if op.arg & loadmarshal.FVS_MASK:
+      stack.build_str(2, op)
+    else:
+      stack.build_str(1, op)
+
+  def _build_string(self, stack, op, code):
+    del code  # unused
+    stack.build_str(op.arg, op)
+
+  def _build_map(self, stack, op, code):
+    del code  # unused
+    map_ = stack.fold_map_args(op.arg, op)
+    if map_:
+      typ = stack.intern(('map', (map_.key_types, map_.value_types)))
+      val = {k: e.value for k, e in map_.elements.items()}
+      stack.push(_Constant(typ, val, map_.elements, op))
+
+  def _build_const_key_map(self, stack, op, code):
+    del code  # unused
+    keys = stack.pop()
+    vals = stack.fold_args(op.arg, op)
+    if vals:
+      keys.op.folded = op
+      _, t = keys.typ
+      key_types = stack.intern(frozenset(t))
+      typ = stack.intern(('map', (key_types, vals.types)))
+      val = {}
+      elements = {}
+      for k, e in zip(keys.value, vals.elements):
+        val[k] = e.value
+        elements[k] = e
+      stack.push(_Constant(typ, val, elements, op))
 
   def visit_code(self, code):
     """Visit code, folding literals."""
-
-    def build_tuple(tup):
-      out = []
-      for e in tup:
-        if isinstance(e, tuple):
-          out.append(build_tuple(e))
-        else:
-          out.append(('prim', type(e)))
-      return ('tuple', tuple(out))
-
-    folds = _FoldedOps()
-    for block in code.order:
-      stack = _Stack()
+    has_build = [any(type(op) in _BUILD_OPCODES for op in block)
+                 for block in code.order]
+    if not any(has_build):
+      return code
+    self._tuple_typestructs = {}
+    handlers = self._handlers
+    # The stack is cleared at the end of every block, so we can share it (and
+    # the constants it preserves) between blocks.
+    stack = _Stack(self._typestructs)
+    # The ops left in the code after folding, in code_iter order.
+    remaining = []
+    for block, block_has_build in zip(code.order, has_build):
+      if not block_has_build:
+        # Nothing in this block can be folded.
+        remaining.extend(block)
+        continue
       for op in block:
-        if isinstance(op, opcodes.LOAD_CONST):
-          elt = code.co_consts[op.arg]
-          if isinstance(elt, tuple):
-            typ = build_tuple(elt)
-            stack.push(_Constant(typ, elt, typ[1], op))
-          else:
-            stack.push(_Constant(('prim', type(elt)), elt, None, op))
-        elif isinstance(op, opcodes.BUILD_LIST):
-          stack.build(list, op)
-        elif isinstance(op, opcodes.BUILD_SET):
-          stack.build(set, op)
-        elif isinstance(op, opcodes.FORMAT_VALUE):
-          if op.arg & loadmarshal.FVS_MASK:
-            stack.build_str(2, op)
-          else:
-            stack.build_str(1, op)
-        elif isinstance(op, opcodes.BUILD_STRING):
-          stack.build_str(op.arg, op)
-        elif isinstance(op, opcodes.BUILD_MAP):
-          map_ = stack.fold_map_args(op.arg, op)
-          if map_:
-            typ = ('map', (map_.key_types, map_.value_types))
-            val = dict(zip(map_.keys, map_.values))
-            stack.push(_Constant(typ, val, map_.elements, op))
-        elif isinstance(op, opcodes.BUILD_CONST_KEY_MAP):
-          keys = stack.pop()
-          vals = stack.fold_args(op.arg, op)
-          if vals:
-            keys.op.folded = op
-            _, t = keys.typ
-            typ = ('map', (frozenset(t), vals.types))
-            val = dict(zip(keys.value, vals.values))
-            elements = dict(zip(keys.value, vals.elements))
-            stack.push(_Constant(typ, val, elements, op))
+        handler = handlers.get(type(op))
+        if handler:
+          handler(stack, op, code)
         else:
           # If we hit any other bytecode, we are no longer building a literal
           # constant. Insert a None as a sentinel to the next BUILD op to
@@ -334,31 +403,33 @@ class _FoldConstants:
           o.target = op.target
           o.block_target = op.block_target
           op.folded = o
-          folds.add(op)
           out.append(o)
-        elif op.folded:
-          folds.add(op)
-        else:
+        elif not op.folded:
           out.append(op)
       block.code = out
+      remaining.extend(out)
 
-    # Adjust 'next' and 'target' pointers to account for folding.
-    for op in code.code_iter:
+    if not stack.consts:
+      # Nothing was folded.
+      return code
+
+    # Adjust 'next' and 'target' pointers to account for folding. Every folded
+    # op has its `folded` attribute pointing either at the op it was folded
+    # into or at the LOAD_FOLDED_CONST that replaced it. This has to wait until
+    # all blocks are folded, since jumps can target ops in later blocks.
+    for op in remaining:
       if op.next:
-        op.next = folds.resolve(op.next)
+        op.next = _resolve_folded(op.next)
       if op.target:
-        op.target = folds.resolve(op.target)
+        op.target = _resolve_folded(op.target)
     return code
 
 
 def to_literal(typ, always_tuple=False):
   """Convert a typestruct item to a simplified form for ease of use."""
 
-  def expand(params):
-    return (to_literal(x) for x in params)
-
   def union(params):
-    ret = tuple(sorted(expand(params), key=str))
+    ret = tuple(sorted([to_literal(x) for x in params], key=str))
     if len(ret) == 1 and not always_tuple:
       ret, = ret  # pylint: disable=self-assigning-variable
     return ret
@@ -367,8 +438,7 @@ def to_literal(typ, always_tuple=False):
   if tag == 'prim':
     return params
   elif tag == 'tuple':
-    vals = tuple(expand(params))
-    return (tag, *vals)
+    return (tag, *[to_literal(x) for x in params])
   elif tag == 'map':
     k, v = params
     return (tag, union(k), union(v))
@@ -379,14 +449,10 @@ def to_literal(typ, always_tuple=False):
 def from_literal(tup):
   """Convert from simple literal form to the more uniform typestruct."""
 
-  def expand(vals):
-    return [from_literal(x) for x in vals]
-
   def union(vals):
     if not isinstance(vals, tuple):
-      vals = (vals,)
-    v = expand(vals)
-    return frozenset(v)
+      return frozenset((from_literal(vals),))
+    return frozenset([from_literal(x) for x in vals])
 
   if not isinstance(tup, tuple):
     return ('prim', tup)
@@ -395,8 +461,7 @@ def from_literal(tup):
     if tag == 'prim':
       return tup
     elif tag == 'tuple':
-      params = tuple(expand(vals))
-      return (tag, params)
+      return (tag, tuple([from_literal(x) for x in vals]))
     elif tag == 'map':
       k, v = vals
       return (tag, (union(k), union(v)))
@@ -404,7 +469,7 @@ def from_literal(tup):
       vals, = vals  # pylint: disable=self-assigning-variable
       return (tag, union(vals))
   else:
-    return tuple(expand(tup))
+    return tuple([from_literal(x) for x in tup])
 
 
 def optimize(code):
@@ -412,8 +477,21 @@ def optimize(code):
   return pyc.visit(code, _FoldConstants())
 
 
-def build_folded_type(ctx, state, const):
-  """Convert a typestruct to a vm type."""
+def build_folded_type(ctx, state, const, cache=None):
+  """Convert a typestruct to a vm type.
+
+  Args:
+    ctx: The abstract context.
+    state: The current frame state.
+    const: The folded constant to convert.
+    cache: Internal; a memo of already built type-only constants, shared by the
+      recursive calls for a single top-level constant.
+
+  Returns:
+    A tuple of the new frame state and the variable for the constant.
+  """
+  if cache is None:
+    cache = {}
 
   def typeconst(t):
     """Create a constant purely to hold types for a recursive call."""
@@ -422,8 +500,16 @@ def build_folded_type(ctx, state, const):
   def build_pyval(state, const):
     if const.value is not None and const.tag in ('prim', 'tuple'):
       return state, ctx.convert.constant_to_var(const.value)
+    elif const.value is None and const.elements is None and const.tag != 'map':
+      # Constants that only carry a type (e.g. the element types of a large
+      # literal) recur within a literal, so we build each of them once per cfg
+      # node. Maps are not memoized, since building one stores into the map.
+      key = (state.node, const.typ)
+      if key not in cache:
+        state, cache[key] = build_folded_type(ctx, state, const, cache)
+      return state, cache[key]
     else:
-      return build_folded_type(ctx, state, const)
+      return build_folded_type(ctx, state, const, cache)
 
   def expand(state, elements):
     vs = []
@@ -463,7 +549,8 @@ def build_folded_type(ctx, state, const):
       # TODO(b/175443170): We should use a smaller MAX_SUBSCRIPT cutoff; this
       # behaviour is unrelated to MAX_VAR_SIZE (which limits the number of
       # distinct bindings for the overall typevar).
-      elts = elements[:MAX_VAR_SIZE] + tuple(typeconst(t) for t in params)
+      elts = itertools.chain(itertools.islice(elements, MAX_VAR_SIZE),
+                             (typeconst(t) for t in params))
       state, vs = expand(state, elts)
       return state, ctx.convert.build_list(state.node, vs)
 
@@ -483,7 +570,7 @@ def build_folded_type(ctx, state, const):
       k_types, v_types = params
       state, v = join_types(state, v_types)
       for t in k_types:
-        state, k = build_folded_type(ctx, state, typeconst(t))
+        state, k = build_folded_type(ctx, state, typeconst(t), cache)
         state = ctx.vm.store_subscr(state, m, k, v)
     return state, m
 
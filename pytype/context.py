@@ -53,6 +53,8 @@ class Context:
     self.annotation_utils = annotation_utils.AnnotationUtils(self)
     self.attribute_handler = attribute.AbstractAttributeHandler(self)
     self.converter_minimally_initialized = False
+    # Builders for classes that need special handling; see _special_classes.
+    self.special_class_builders = None
     self.convert = convert.Converter(self)
     self.pytd_convert = output.Converter(self)
     self.program.default_data = self.convert.unsolvable
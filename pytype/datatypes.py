@@ -68,7 +68,7 @@ class UnionFind:
     key1 = self._get_or_add_id(name1)
     key2 = self._get_or_add_id(name2)
     self._merge(key1, key2)
-    return self.find_by_name(name1)
+    return self.id2name[self._find(key1)]
 
   def _get_or_add_id(self, name):
     if name not in self.name2id:
@@ -82,11 +82,13 @@ class UnionFind:
   def _find(self, key):
     """Find the tree root."""
     assert self.latest_id > key
+    parent = self.parent
     res = key
-    if self.parent[key] != key:
-      res = self._find(self.parent[key])
-      # Compress/Optimize the search path
-      self.parent[key] = res
+    while parent[res] != res:
+      res = parent[res]
+    # Compress/Optimize the search path
+    while parent[key] != res:
+      parent[key], key = res, parent[key]
     return res
 
   def _merge(self, k1, k2):
@@ -163,6 +165,17 @@ class MonitorDict(dict):
     return itertools.chain.from_iterable(v.data for v in self.values())
 
 
+class ImmutableDict(dict):
+  """A dict that cannot be modified, so that one instance can be shared."""
+
+  def _immutable(self, *args, **kwargs):
+    raise TypeError("%s does not support modification" %
+                    self.__class__.__name__)
+
+  __setitem__ = __delitem__ = __ior__ = _immutable
+  clear = pop = popitem = setdefault = update = _immutable
+
+
 class AliasingDictConflictError(Exception):
 
   def __init__(self, existing_name):
@@ -194,8 +207,9 @@ class AliasingDict(dict):
   def copy(self):
     res = AliasingDict()
     res.uf = self.uf.copy()
-    for k, v in self.items():
-      res[k] = v
+    # Our keys are already representatives in the copied UnionFind, so we can
+    # skip the alias lookups in __setitem__.
+    dict.update(res, self)
     return res
 
   def add_alias(self, alias, name, op=None):
@@ -46,6 +46,37 @@ class AccessTrackingDictTest(unittest.TestCase):
     self.assertEqual(v, 3)
 
 
+class ImmutableDictTest(unittest.TestCase):
+  """Test ImmutableDict."""
+
+  def setUp(self):
+    super().setUp()
+    self.d = datatypes.ImmutableDict({"a": 1})
+
+  def test_get(self):
+    self.assertEqual(self.d["a"], 1)
+    self.assertEqual(self.d, {"a": 1})
+
+  def test_modify(self):
+    with self.assertRaises(TypeError):
+      self.d["b"] = 2
+    with self.assertRaises(TypeError):
+      del self.d["a"]
+    with self.assertRaises(TypeError):
+      self.d.update({"b": 2})
+    with self.assertRaises(TypeError):
+      self.d.setdefault("b", 2)
+    with self.assertRaises(TypeError):
+      self.d.pop("a")
+    self.assertEqual(self.d, {"a": 1})
+
+  def test_copy(self):
+    d = self.d.copy()
+    d["b"] = 2
+    self.assertEqual(d, {"a": 1, "b": 2})
+    self.assertEqual(self.d, {"a": 1})
+
+
 class DatatypesTest(unittest.TestCase):
   """Test datatypes."""
 
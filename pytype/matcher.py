@@ -25,6 +25,29 @@ _COMPATIBLE_BUILTINS = [
     ("builtins." + compatible_builtin, "builtins." + builtin)
     for compatible_builtin, builtin in pep484.COMPAT_ITEMS
 ]
+# For membership tests; iteration order of _COMPATIBLE_BUILTINS matters.
+_COMPATIBLE_BUILTINS_SET = frozenset(_COMPATIBLE_BUILTINS)
+
+# Formal types that every value of a given kind matches.
+_CLASS_TYPE_NAMES = frozenset({
+    "builtins.type", "builtins.object", "typing.Callable", "typing.Hashable"})
+_MODULE_TYPE_NAMES = frozenset({
+    "builtins.module", "builtins.object", "types.ModuleType",
+    "typing.Hashable"})
+_CLASSMETHOD_TYPE_NAMES = frozenset({"builtins.classmethod", "builtins.object"})
+_STATICMETHOD_TYPE_NAMES = frozenset({
+    "builtins.staticmethod", "builtins.object"})
+
+# Iterable types that str is not matched against by default, and the names of
+# str itself.
+_CONFLICTING_ITER_TYPE_NAMES = frozenset({
+    "typing.Iterable", "typing.Sequence", "typing.Collection",
+    "typing.Container"})
+_STR_TYPE_NAMES = frozenset({"builtins.str", "builtins.unicode"})
+
+# Values whose class says nothing about the values a TypeVar may take.
+_NON_CONCRETE_VALUE_TYPES = abstract.AMBIGUOUS_OR_EMPTY + (
+    abstract.Union, abstract.TypeParameterInstance)
 
 
 def _is_callback_protocol(typ):
@@ -32,6 +55,24 @@ def _is_callback_protocol(typ):
           "__call__" in typ.protocol_attributes)
 
 
+def _is_concrete_value(v):
+  """Whether v is a value that TypeVar consistency checks need to look at."""
+  # TODO(rechen): For type parameter instances, we should extract the concrete
+  # value from v.instance so that we can check it, rather than ignoring the
+  # value altogether.
+  # TODO(b/200220895): This is probably wrong; we should expand unions instead
+  # of ignoring them.
+  return (not isinstance(v, _NON_CONCRETE_VALUE_TYPES) and
+          not isinstance(v.cls, abstract.AMBIGUOUS_OR_EMPTY))
+
+
+def _is_plain_class(cls):
+  """Whether every instance of cls trivially matches cls."""
+  return (isinstance(cls, abstract.Class) and not cls.formal and
+          not isinstance(cls, (abstract.ParameterizedClass,
+                               typed_dict.TypedDictClass)))
+
+
 class NonIterableStrError(Exception):
   """Error for matching `str` against `Iterable[str]`/`Sequence[str]`/etc."""
 
@@ -57,12 +98,33 @@ class ProtocolMissingAttributesError(ProtocolError):
 
 
 class ProtocolTypeError(ProtocolError):
+  """Error for a protocol attribute with the wrong type.
+
+  The actual and expected types are given as sequences of values and merged
+  on first access, since most errors are discarded without being printed.
+  """
 
   def __init__(self, left_type, other_type, attribute, actual, expected):
     super().__init__(left_type, other_type)
     self.attribute_name = attribute
-    self.actual_type = actual
-    self.expected_type = expected
+    self._actual_values = actual
+    self._expected_values = expected
+    self._actual_type = None
+    self._expected_type = None
+
+  @property
+  def actual_type(self):
+    if self._actual_type is None:
+      self._actual_type = self.left_type.ctx.convert.merge_values(
+          self._actual_values)
+    return self._actual_type
+
+  @property
+  def expected_type(self):
+    if self._expected_type is None:
+      self._expected_type = self.left_type.ctx.convert.merge_values(
+          self._expected_values)
+    return self._expected_type
 
 
 class TypedDictError(Exception):
@@ -87,8 +149,49 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
   def __init__(self, node, ctx):
     super().__init__(ctx)
     self._node = node
-    self._protocol_cache = set()
+    # Partially matched (class, protocol) pairs, in the order they were added,
+    # so that a tracking scope can remove exactly the keys it added. The values
+    # are unused; a dict is used as an insertion-ordered set.
+    self._protocol_cache = {}
+    # Maps (id(value), id(protocol)) to (value, protocol, error) for values
+    # that lack some of the protocol's attributes. Such a failure depends on
+    # neither the substitution nor the view, so it can be replayed.
+    self._protocol_missing_cache = {}
+    # Maps (id(class), id(protocol)) to (class, protocol, the attribute that
+    # made the last attempt to match them fail).
+    self._failed_protocol_attributes = {}
+    # Maps id(protocol) to (protocol, protocol_attributes, the attributes in
+    # sorted order). protocol_attributes may be reassigned while the class is
+    # being initialized, so entries are only valid for the same set object.
+    self._sorted_protocol_attributes = {}
     self._recursive_annots_cache = set()
+    # Maps (id(class), id(formal type)) to (class, formal type, the result of
+    # match_from_mro). The same class is matched against the same type for
+    # every view of a variable, and the result depends on neither the view nor
+    # the substitution. Identity keys avoid hashing parameterized classes.
+    self._mro_match_cache = {}
+    # Maps id(annotation) to (annotation, its type parameters). Keeping the
+    # annotation alive guarantees that the id is not reused.
+    self._type_params_cache = {}
+    # Maps id(late annotation) to (annotation, whether it is recursive).
+    self._recursive_annot_flags = {}
+    # Maps id(class) to (class, names of the attributes defined in its MRO).
+    self._class_attr_names_cache = {}
+    # Maps id(class) to (class, names of its superclasses and of the builtins
+    # it is compatible with).
+    self._superclass_names_cache = {}
+    # Maps (id(protocol), id(attribute)) to (protocol, attribute, the types
+    # that a value must match to implement the attribute).
+    self._attribute_types_cache = {}
+    # Maps id(callable type) to (callable type, its param matcher).
+    self._param_matcher_cache = {}
+    # Maps id(function) to (function, its signatures).
+    self._signatures_cache = {}
+    # Maps id(variable) to (variable, number of bindings, bindings grouped by
+    # the type key of their data).
+    self._type_key_index = {}
+    # An 'object' instance at self._node, for substituting type parameters.
+    self._object_var = None
     self._protocol_error = None
     self._noniterable_str_error = None
     self._typed_dict_error = None
@@ -106,9 +209,49 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
     Yields:
       Into the protocol matching context.
     """
-    old_protocol_cache = set(self._protocol_cache)
+    mark = len(self._protocol_cache)
     yield
-    self._protocol_cache = old_protocol_cache
+    while len(self._protocol_cache) > mark:
+      self._protocol_cache.popitem()
+
+  def _get_type_parameters(self, annot):
+    """Memoized version of annotation_utils.get_type_parameters."""
+    entry = self._type_params_cache.get(id(annot))
+    if entry is None:
+      params = tuple(self.ctx.annotation_utils.get_type_parameters(annot))
+      entry = self._type_params_cache[id(annot)] = (annot, params)
+    return entry[1]
+
+  def _is_recursive_annotation(self, annot):
+    """Memoized version of abstract_utils.is_recursive_annotation."""
+    if not annot.is_late_annotation():
+      return False
+    entry = self._recursive_annot_flags.get(id(annot))
+    if entry is not None:
+      return entry[1]
+    is_recursive = annot.is_recursive()
+    # An unresolved annotation may still turn out to be recursive.
+    if annot.resolved:
+      self._recursive_annot_flags[id(annot)] = (annot, is_recursive)
+    return is_recursive
+
+  def _get_signatures(self, func):
+    """Memoized version of function.get_signatures."""
+    entry = self._signatures_cache.get(id(func))
+    if entry is None:
+      entry = self._signatures_cache[id(func)] = (
+          func, tuple(function.get_signatures(func)))
+    return entry[1]
+
+  def _get_bindings_by_type_key(self, var):
+    """Group the bindings of a variable by the type key of their data."""
+    entry = self._type_key_index.get(id(var))
+    if entry is None or entry[1] != len(var.bindings):
+      index = collections.defaultdict(list)
+      for b in var.bindings:
+        index[b.data.get_type_key()].append(b)
+      entry = self._type_key_index[id(var)] = (var, len(var.bindings), index)
+    return entry[2]
 
   def _error_details(self):
     """Package up additional error details."""
@@ -224,7 +367,7 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
             isinstance(other_type, abstract.ParameterizedClass) and
             other_type.base_cls is base_cls) or (allow_compat_builtins and (
                 (base_cls.full_name,
-                 other_type.full_name) in _COMPATIBLE_BUILTINS)):
+                 other_type.full_name) in _COMPATIBLE_BUILTINS_SET)):
           return base
       elif isinstance(base_cls, abstract.AMBIGUOUS):
         # Note that this is a different logic than in pytd/type_match.py, which
@@ -272,7 +415,7 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
       # constraints even if t1 is bounded.
       if not t1.constraints:
         return None  # t1 is unconstrained, t2 has constraints
-      if set(t1.constraints) - set(t2.constraints):
+      if any(c not in t2.constraints for c in t1.constraints):
         return None  # t1 is more permissive than t2
     elif t2.bound:
       if t1.bound:
@@ -322,8 +465,14 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
     left = self._unwrap_final(left)
     other_type = self._unwrap_final(other_type)
 
+    if (isinstance(left, abstract.Instance) and left.cls is other_type and
+        not left.formal and _is_plain_class(other_type)):
+      # Fast path: an instance of a plain class matches that class without
+      # changing subst.
+      return subst
+
     # Make sure we don't recurse infinitely when matching recursive types.
-    if abstract_utils.is_recursive_annotation(other_type):
+    if self._is_recursive_annotation(other_type):
       key = (left, other_type)
       if key in self._recursive_annots_cache:
         return subst
@@ -335,10 +484,12 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
       # parameters with 'object' so that they don't match concrete types like
       # 'int' but still match things like 'Any'.
       type_params = self.ctx.annotation_utils.get_type_parameters(left)
-      obj_var = self.ctx.convert.primitive_class_instances[object].to_variable(
-          self._node)
+      if self._object_var is None:
+        self._object_var = self.ctx.convert.primitive_class_instances[
+            object].to_variable(self._node)
       left = self.ctx.annotation_utils.sub_one_annotation(
-          self._node, left, [{p.full_name: obj_var for p in type_params}])
+          self._node, left,
+          [{p.full_name: self._object_var for p in type_params}])
     assert not left.formal, left
 
     if isinstance(left, abstract.TypeParameterInstance) and (
@@ -404,10 +555,12 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
       # Every value with this type key produces the same result when matched
       # against other_type, so they can all be added to this substitution rather
       # than matched separately.
-      for other_value in value.variable.bindings:
-        if (other_value is not value and
-            other_value.data.get_type_key() == type_key):
-          new_var.AddBinding(other_value.data, {other_value}, self._node)
+      add_binding = new_var.AddBinding
+      node = self._node
+      for other_value in self._get_bindings_by_type_key(
+          value.variable).get(type_key, ()):
+        if other_value is not value:
+          add_binding(other_value.data, {other_value}, node)
       if other_type.constraints:
         new_values = self._discard_ambiguous_values(new_var.data)
         has_error = not self._satisfies_single_type(new_values)
@@ -419,16 +572,14 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
         if other_type.full_name in subst:
           has_error = False
           old_values = subst[other_type.full_name].data
-          # If _discard_ambiguous_values does not discard 'left', then it is a
-          # concrete value that we need to match.
-          if old_values and self._discard_ambiguous_values([left]):
-            old_concrete_values = self._discard_ambiguous_values(old_values)
+          # If 'left' is a concrete value, then we need to match it.
+          if old_values and _is_concrete_value(left):
             # If any of the previous TypeVar values were ambiguous, then we
             # treat the match as a success. Otherwise, 'left' needs to match at
             # least one of them.
-            if len(old_values) == len(old_concrete_values):
+            if all(_is_concrete_value(v) for v in old_values):
               has_error = True
-              for old_value in old_concrete_values:
+              for old_value in old_values:
                 if self._satisfies_common_superclass([left, old_value]):
                   has_error = False
                 elif old_value.cls.is_protocol:
@@ -469,13 +620,24 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
       # not result in `None` being a valid substitution for `T`. We order the
       # options so that ones without type parameters are checked first, so we
       # can break early if any of them match.
+      if (isinstance(left, abstract.Instance) and
+          _is_plain_class(left.cls) and
+          any(t is left.cls for t in other_type.options)):
+        # Fast path: an instance of a plain class always matches that class,
+        # without changing subst, so we do not need to try the other options.
+        return self._subst_with_type_parameters_from(subst, other_type)
       matched = False
-      # By sorting first by whether the option contains type parameters and then
-      # by its index, we move options without type parameters to the front and
-      # otherwise preserve the original order.
-      options = sorted(enumerate(other_type.options),
-                       key=lambda itm: (itm[1].formal, itm[0]))
-      for _, t in options:
+      # Move options without type parameters to the front, otherwise preserving
+      # the original order.
+      options = []
+      formal_options = []
+      for t in other_type.options:
+        if t.formal:
+          formal_options.append(t)
+        else:
+          options.append(t)
+      options.extend(formal_options)
+      for t in options:
         new_subst = self._match_value_against_type(value, t, subst, view)
         if new_subst is None:
           continue
@@ -517,111 +679,136 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
     if (isinstance(left, abstract.Empty) and
         isinstance(other_type, abstract.Empty)):
       return subst
-    elif isinstance(left, abstract.AMBIGUOUS_OR_EMPTY):
-      params = self.ctx.annotation_utils.get_type_parameters(other_type)
-      if isinstance(left, abstract.Empty):
-        value = self.ctx.convert.empty
+    left_cls = type(left)
+    try:
+      match = _LEFT_MATCHER_CACHE[left_cls]
+    except KeyError:
+      for left_types, match in _LEFT_MATCHERS:
+        if issubclass(left_cls, left_types):
+          break
       else:
-        value = self.ctx.convert.unsolvable
-      return self._mutate_type_parameters(params, value, subst)
-    elif isinstance(left, abstract.Class):
-      if (other_type.full_name == "builtins.type" and
+        match = None
+      _LEFT_MATCHER_CACHE[left_cls] = match
+    if match is None:
+      raise NotImplementedError("Matching not implemented for %s against %s" %
+                                (type(left), type(other_type)))
+    return match(self, left, other_type, subst, view)
+
+  def _match_ambiguous_against_type(self, left, other_type, subst, view):
+    del view  # unused
+    params = self._get_type_parameters(other_type)
+    if isinstance(left, abstract.Empty):
+      value = self.ctx.convert.empty
+    else:
+      value = self.ctx.convert.unsolvable
+    return self._mutate_type_parameters(params, value, subst)
+
+  def _match_class_against_type(self, left, other_type, subst, view):
+    other_name = other_type.full_name
+    if (other_name == "builtins.type" and
+        isinstance(other_type, abstract.ParameterizedClass)):
+      other_type = other_type.get_formal_type_parameter(abstract_utils.T)
+      return self._instantiate_and_match(left, other_type, subst, view)
+    elif (other_name == "typing.Callable" and
           isinstance(other_type, abstract.ParameterizedClass)):
-        other_type = other_type.get_formal_type_parameter(abstract_utils.T)
-        return self._instantiate_and_match(left, other_type, subst, view)
-      elif (other_type.full_name == "typing.Callable" and
-            isinstance(other_type, abstract.ParameterizedClass)):
-        # TODO(rechen): Check left's constructor against the callable's params.
-        other_type = other_type.get_formal_type_parameter(abstract_utils.RET)
-        return self._instantiate_and_match(left, other_type, subst, view)
-      elif other_type.full_name in [
-          "builtins.type", "builtins.object", "typing.Callable",
-          "typing.Hashable"]:
-        return subst
-      elif _is_callback_protocol(other_type):
-        return self._match_type_against_callback_protocol(
-            left, other_type, subst, view)
-      else:
-        return self._match_instance_against_type(left, other_type, subst, view)
-    elif isinstance(left, abstract.Module):
-      if other_type.full_name in [
-          "builtins.module", "builtins.object", "types.ModuleType",
-          "typing.Hashable"]:
-        return subst
-      elif (isinstance(other_type, abstract.Class) and
-            other_type.has_protocol_base()):
-        return self._match_instance_against_type(
-            left, other_type, subst, view)
-      else:
-        return None
-    elif isinstance(left, abstract.FUNCTION_TYPES):
-      if other_type.full_name == "builtins.object":
-        return subst
-      elif other_type.full_name == "typing.Callable":
-        if not isinstance(other_type, abstract.ParameterizedClass):
-          # The callable has no parameters, so any function matches it.
-          return subst
-        if isinstance(left, abstract.NativeFunction):
-          # If we could get the class on which 'left' is defined (perhaps by
-          # using bound_class?), we could get the argument and return types
-          # from the underlying PyTDFunction, but we wouldn't get much value
-          # out of that additional matching, since most NativeFunction objects
-          # are magic methods like __getitem__ which aren't likely to be passed
-          # as function arguments.
-          return subst
-        signatures = function.get_signatures(left)
-        new_substs = []
-        for sig in signatures:
-          new_subst = self._match_signature_against_callable(
-              sig, other_type, subst, view)
-          if new_subst is not None:
-            new_substs.append(new_subst)
-        if new_substs:
-          return self._merge_substs(subst, new_substs)
-        else:
-          return None
-      elif _is_callback_protocol(other_type):
-        return self._match_type_against_callback_protocol(
-            left, other_type, subst, view)
-      else:
-        return self._match_type_against_type(
-            abstract.Instance(left.cls, self.ctx), other_type, subst, view)
-    elif isinstance(left, dataclass_overlay.FieldInstance) and left.default:
-      return self._match_all_bindings(left.default, other_type, subst, view)
-    elif isinstance(left, abstract.SimpleValue):
+      # TODO(rechen): Check left's constructor against the callable's params.
+      other_type = other_type.get_formal_type_parameter(abstract_utils.RET)
+      return self._instantiate_and_match(left, other_type, subst, view)
+    elif other_name in _CLASS_TYPE_NAMES:
+      return subst
+    elif _is_callback_protocol(other_type):
+      return self._match_type_against_callback_protocol(
+          left, other_type, subst, view)
+    else:
       return self._match_instance_against_type(left, other_type, subst, view)
-    elif isinstance(left, special_builtins.SuperInstance):
-      instance = left.super_obj or abstract.Instance(left.super_cls, self.ctx)
+
+  def _match_module_against_type(self, left, other_type, subst, view):
+    if other_type.full_name in _MODULE_TYPE_NAMES:
+      return subst
+    elif (isinstance(other_type, abstract.Class) and
+          other_type.has_protocol_base()):
       return self._match_instance_against_type(
-          instance, other_type, subst, view)
-    elif isinstance(left, abstract.ClassMethod):
-      if other_type.full_name in [
-          "builtins.classmethod", "builtins.object"]:
+          left, other_type, subst, view)
+    else:
+      return None
+
+  def _match_function_against_type(self, left, other_type, subst, view):
+    other_name = other_type.full_name
+    if other_name == "builtins.object":
+      return subst
+    elif other_name == "typing.Callable":
+      if not isinstance(other_type, abstract.ParameterizedClass):
+        # The callable has no parameters, so any function matches it.
         return subst
-      return self._match_type_against_type(
-          left.to_bound_function(), other_type, subst, view)
-    elif isinstance(left, abstract.StaticMethod):
-      if other_type.full_name in [
-          "builtins.staticmethod", "builtins.object"]:
+      if isinstance(left, abstract.NativeFunction):
+        # If we could get the class on which 'left' is defined (perhaps by
+        # using bound_class?), we could get the argument and return types
+        # from the underlying PyTDFunction, but we wouldn't get much value
+        # out of that additional matching, since most NativeFunction objects
+        # are magic methods like __getitem__ which aren't likely to be passed
+        # as function arguments.
         return subst
-      return self._match_type_against_type(left.method, other_type, subst, view)
-    elif isinstance(left, abstract.Union):
-      for o in left.options:
-        new_subst = self._match_type_against_type(o, other_type, subst, view)
+      signatures = self._get_signatures(left)
+      new_substs = []
+      for sig in signatures:
+        new_subst = self._match_signature_against_callable(
+            sig, other_type, subst, view)
         if new_subst is not None:
-          return new_subst
-    elif isinstance(left, abstract.TypeParameterInstance):
-      if isinstance(left.instance, abstract.BaseValue):
-        param = left.instance.get_instance_type_parameter(left.param.name)
-        # If left resolves to itself
-        # (see tests/test_enums:EnumOverlayTest.test_unique_enum_in_dict),
-        # calling _match_all_bindings would lead to an infinite recursion error.
-        if param.bindings and not any(v is left for v in param.data):
-          return self._match_all_bindings(param, other_type, subst, view)
-      return self._instantiate_and_match(left.param, other_type, subst, view)
+          new_substs.append(new_subst)
+      if new_substs:
+        return self._merge_substs(subst, new_substs)
+      else:
+        return None
+    elif _is_callback_protocol(other_type):
+      return self._match_type_against_callback_protocol(
+          left, other_type, subst, view)
     else:
-      raise NotImplementedError("Matching not implemented for %s against %s" %
-                                (type(left), type(other_type)))
+      return self._match_type_against_type(
+          abstract.Instance(left.cls, self.ctx), other_type, subst, view)
+
+  def _match_field_against_type(self, left, other_type, subst, view):
+    if left.default:
+      return self._match_all_bindings(left.default, other_type, subst, view)
+    return self._match_instance_against_type(left, other_type, subst, view)
+
+  def _match_super_against_type(self, left, other_type, subst, view):
+    instance = left.super_obj or abstract.Instance(left.super_cls, self.ctx)
+    return self._match_instance_against_type(instance, other_type, subst, view)
+
+  def _match_classmethod_against_type(self, left, other_type, subst, view):
+    if other_type.full_name in _CLASSMETHOD_TYPE_NAMES:
+      return subst
+    return self._match_type_against_type(
+        left.to_bound_function(), other_type, subst, view)
+
+  def _match_staticmethod_against_type(self, left, other_type, subst, view):
+    if other_type.full_name in _STATICMETHOD_TYPE_NAMES:
+      return subst
+    return self._match_type_against_type(left.method, other_type, subst, view)
+
+  def _match_union_against_type(self, left, other_type, subst, view):
+    if (other_type.full_name in _CLASS_TYPE_NAMES and
+        not isinstance(other_type, abstract.ParameterizedClass) and
+        any(isinstance(o, abstract.Class) for o in left.options)):
+      # Every class matches these types without changing subst, so there is
+      # no need to dispatch on each option.
+      return subst
+    for o in left.options:
+      new_subst = self._match_type_against_type(o, other_type, subst, view)
+      if new_subst is not None:
+        return new_subst
+    return None
+
+  def _match_type_param_instance_against_type(
+      self, left, other_type, subst, view):
+    if isinstance(left.instance, abstract.BaseValue):
+      param = left.instance.get_instance_type_parameter(left.param.name)
+      # If left resolves to itself
+      # (see tests/test_enums:EnumOverlayTest.test_unique_enum_in_dict),
+      # calling _match_all_bindings would lead to an infinite recursion error.
+      if param.bindings and not any(v is left for v in param.data):
+        return self._match_all_bindings(param, other_type, subst, view)
+    return self._instantiate_and_match(left.param, other_type, subst, view)
 
   def _match_type_against_callback_protocol(
       self, left, other_type, subst, view):
@@ -633,7 +820,7 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
       return None
     new_substs = []
     for expected_method in method_var.data:
-      signatures = function.get_signatures(expected_method)
+      signatures = self._get_signatures(expected_method)
       for sig in signatures:
         sig = sig.drop_first_parameter()  # drop `self`
         expected_callable = (self.ctx.pytd_convert.signature_to_callable(sig))
@@ -649,7 +836,12 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
     return self._merge_substs(subst, new_substs)
 
   def _mutate_type_parameters(self, params, value, subst):
-    new_subst = {p.full_name: value.to_variable(self._node) for p in params}
+    # Type parameters can appear several times in an annotation. Each name gets
+    # its own variable, since _merge_substs may later paste into it in place.
+    new_subst = {}
+    for p in params:
+      if p.full_name not in new_subst:
+        new_subst[p.full_name] = value.to_variable(self._node)
     return self._merge_substs(subst, [new_subst])
 
   def _get_param_matcher(self, callable_type):
@@ -668,6 +860,9 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
       should next attempt normal matching on the inputs. (See
       _match_signature_against_callable for a usage example.)
     """
+    entry = self._param_matcher_cache.get(id(callable_type))
+    if entry is not None:
+      return entry[1]
     # Any type parameter should match an unconstrained, unbounded type parameter
     # that appears exactly once in a callable, in order for matching to succeed
     # in cases like:
@@ -677,18 +872,20 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
     # Normally, we would treat the `T` in `Callable[[T], Any]` as meaning that
     # the callable must accept any argument, but here, it means that the
     # argument must be the same type as `x`.
-    callable_param_count = collections.Counter(
-        self.ctx.annotation_utils.get_type_parameters(callable_type))
+    callable_param_count = {}
+    for p in self._get_type_parameters(callable_type):
+      callable_param_count[p] = callable_param_count.get(p, 0) + 1
     if isinstance(callable_type, abstract.CallableClass):
       # In CallableClass, type parameters in arguments are double-counted
       # because ARGS contains the union of the individual arguments.
-      callable_param_count.subtract(
-          self.ctx.annotation_utils.get_type_parameters(
-              callable_type.get_formal_type_parameter(abstract_utils.ARGS)))
+      for p in self._get_type_parameters(
+          callable_type.get_formal_type_parameter(abstract_utils.ARGS)):
+        callable_param_count[p] = callable_param_count.get(p, 0) - 1
     def match(left, right, subst):
       if (not isinstance(left, abstract.TypeParameter) or
           not isinstance(right, abstract.TypeParameter) or
-          right.constraints or right.bound or callable_param_count[right] != 1):
+          right.constraints or right.bound or
+          callable_param_count.get(right) != 1):
         return None
       subst = subst.copy()
       # We don't know what to fill in here, since we have a TypeVar matching a
@@ -696,6 +893,7 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
       subst[right.full_name] = self.ctx.program.NewVariable(
           [self.ctx.convert.empty], [], self._node)
       return subst
+    self._param_matcher_cache[id(callable_type)] = (callable_type, match)
     return match
 
   def _match_signature_against_callable(self, sig, other_type, subst, view):
@@ -721,14 +919,17 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
     max_argcount = sig.maximum_param_count()
     if max_argcount is not None and max_argcount < other_type.num_args:
       return None
-    for name, expected_arg in zip(sig.param_names,
-                                  (other_type.formal_type_parameters[i]
-                                   for i in range(other_type.num_args))):
-      actual_arg = sig.annotations.get(name, self.ctx.convert.unsolvable)
+    annotations = sig.annotations
+    unsolvable = self.ctx.convert.unsolvable
+    formal_type_parameters = other_type.formal_type_parameters
+    instantiate_and_match = self._instantiate_and_match
+    for i, name in enumerate(sig.param_names[:other_type.num_args]):
+      actual_arg = annotations.get(name, unsolvable)
+      expected_arg = formal_type_parameters[i]
       new_subst = param_match(actual_arg, expected_arg, subst)
       if new_subst is None:
         # Flip actual and expected, since argument types are contravariant.
-        subst = self._instantiate_and_match(
+        subst = instantiate_and_match(
             expected_arg, actual_arg, subst, view, container=other_type)
         if subst is None:
           return None
@@ -737,25 +938,51 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
     return subst
 
   def _merge_substs(self, subst, new_substs):
-    subst = subst.copy()
+    """Merges new_substs into subst, copying it only if new names are added."""
+    merged = subst
     for new_subst in new_substs:
+      if new_subst is subst:
+        continue
       for name, var in new_subst.items():
-        if name not in subst:
-          subst[name] = var
-        elif subst[name] is not var:
-          subst[name].PasteVariable(var)
-    return subst
+        if name not in merged:
+          if merged is subst:
+            merged = subst.copy()
+          merged[name] = var
+        elif merged[name] is not var:
+          merged[name].PasteVariable(var)
+    return merged
 
   def _instantiate_and_match(self, left, other_type, subst, view,
                              container=None):
     """Instantiate and match an abstract value."""
+    if left is self.ctx.convert.unsolvable:
+      # Fast path for the common case of an unannotated parameter or return
+      # type: Any matches any type, filling in its type parameters with Any.
+      if isinstance(other_type, (abstract.Unknown, abstract.Unsolvable)):
+        return subst
+      elif isinstance(other_type, abstract.Class):
+        return self._mutate_type_parameters(
+            self._get_type_parameters(other_type), left, subst)
     instance = left.instantiate(self._node, container=container)
     return self._match_all_bindings(instance, other_type, subst, view)
 
+  def _get_views(self, var):
+    """Gets the views of var, with a fast path for a single plain binding."""
+    bindings = var.bindings
+    if len(bindings) == 1:
+      binding = bindings[0]
+      # Without parameters to expand, get_views would produce at most this one
+      # view, if the binding is reachable.
+      if not any(binding.data.unique_parameter_values()):
+        if self._node.CanHaveCombination([binding]):
+          return ({var: binding},)
+        return ()
+    return abstract_utils.get_views([var], self._node)
+
   def _match_all_bindings(self, var, other_type, subst, view):
     """Matches all of var's bindings against other_type."""
     new_substs = []
-    for new_view in abstract_utils.get_views([var], self._node):
+    for new_view in self._get_views(var):
       # When new_view and view have entries in common, we want to use the
       # entries from the old view.
       new_view.update(view)
@@ -789,12 +1016,13 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
       if isinstance(left, abstract.ConcreteValue) and isinstance(
           other_value, abstract.ConcreteValue):
         return subst if left.pyval == other_value.pyval else None
-      elif (isinstance(left, abstract.Instance) and left.cls.is_enum and
+      elif (isinstance(left, abstract.Instance) and
             isinstance(other_value, abstract.Instance) and
-            other_value.cls.is_enum):
-        names_match = left.name == other_value.name
-        clses_match = left.cls == other_value.cls
-        return subst if names_match and clses_match else None
+            left.cls == other_value.cls and left.cls.is_enum):
+        # Enum members match if they are the same member of the same enum.
+        # Comparing the classes first means is_enum, which walks the
+        # metaclass's MRO, is computed at most once.
+        return subst if left.name == other_value.name else None
       else:
         return None
     elif isinstance(other_type, typed_dict.TypedDictClass):
@@ -802,10 +1030,16 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
         return None
       return subst
     elif isinstance(other_type, abstract.Class):
-      if not self._satisfies_noniterable_str(left.cls, other_type):
+      if (other_type.full_name in _CONFLICTING_ITER_TYPE_NAMES and
+          not self._satisfies_noniterable_str(left.cls, other_type)):
         self._noniterable_str_error = NonIterableStrError(left.cls, other_type)
         return None
-      base = self.match_from_mro(left.cls, other_type)
+      key = (id(left.cls), id(other_type))
+      entry = self._mro_match_cache.get(key)
+      if entry is None:
+        entry = self._mro_match_cache[key] = (
+            left.cls, other_type, self.match_from_mro(left.cls, other_type))
+      base = entry[2]
       if base is None:
         if other_type.is_protocol:
           with self._track_partially_matched_protocols():
@@ -886,7 +1120,7 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
             instance_type_param.name != type_param.name):
           # This type parameter was renamed!
           instance_param = instance.get_instance_type_parameter(
-              type_param.full_name, self._node)
+              instance_type_param.full_name, self._node)
         if instance_param.bindings and instance_param not in view:
           binding, = instance_param.bindings
           assert isinstance(binding.data, abstract.Unsolvable), binding.data
@@ -902,17 +1136,21 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
                                           subst, view):
     """Used by _match_instance."""
     if isinstance(instance, abstract.Tuple):
+      if not instance.pyval:
+        if (isinstance(other_type, abstract.TupleClass) and
+            other_type.tuple_length):
+          return None
+        # This call puts the right param names (with empty values) into subst.
+        return self._match_maybe_parameterized_instance(
+            left, instance, other_type, subst, view)
       if isinstance(other_type, abstract.TupleClass):
-        if instance.tuple_length == other_type.tuple_length:
-          for i in range(instance.tuple_length):
-            instance_param = instance.pyval[i]
-            class_param = other_type.formal_type_parameters[i]
-            subst = self.match_var_against_type(
-                instance_param, class_param, subst, view)
-            if subst is None:
-              return None
-        else:
+        if instance.tuple_length != other_type.tuple_length:
           return None
+        class_params = other_type.formal_type_parameters
+        subst = self._match_vars_against_types(
+            ((instance_param, class_params[i])
+             for i, instance_param in enumerate(instance.pyval)),
+            subst, view)
       elif isinstance(other_type, abstract.ParameterizedClass):
         class_param = other_type.get_formal_type_parameter(abstract_utils.T)
         # Copying the parameters directly preserves literal values. In most
@@ -937,12 +1175,7 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
             if new_subst is None:
               return None
           new_substs.append(new_subst)
-        if new_substs:
-          subst = self._merge_substs(subst, new_substs)
-      if not instance.pyval:
-        # This call puts the right param names (with empty values) into subst.
-        subst = self._match_maybe_parameterized_instance(
-            left, instance, other_type, subst, view)
+        subst = self._merge_substs(subst, new_substs)
     elif isinstance(left, abstract.TupleClass):
       # We have an instance of a subclass of tuple.
       return self._instantiate_and_match(left, other_type, subst, view)
@@ -951,12 +1184,20 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
       if isinstance(instance, abstract.SimpleValue):
         instance_param = instance.get_instance_type_parameter(
             abstract_utils.T, self._node)
-        for i in range(other_type.tuple_length):
-          class_param = other_type.formal_type_parameters[i]
-          subst = self.match_var_against_type(
-              instance_param, class_param, subst, view)
-          if subst is None:
-            return None
+        class_params = other_type.formal_type_parameters
+        subst = self._match_vars_against_types(
+            ((instance_param, class_params[i])
+             for i in range(other_type.tuple_length)),
+            subst, view)
+    return subst
+
+  def _match_vars_against_types(self, pairs, subst, view):
+    """Matches (variable, type) pairs in order, threading subst through."""
+    match_var_against_type = self.match_var_against_type
+    for var, other_type in pairs:
+      subst = match_var_against_type(var, other_type, subst, view)
+      if subst is None:
+        return None
     return subst
 
   def _match_callable_instance(self, left, instance, other_type, subst, view):
@@ -996,6 +1237,8 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
     if not isinstance(left, abstract.Dict):
       return False
     missing, extra = other_type.props.check_keys(left.pyval.keys())
+    # bad_matches() re-enters the matcher, so the values are checked now rather
+    # than when the error is reported.
     bad = []
     fields = other_type.props.fields
     for k, v in left.pyval.items():
@@ -1010,22 +1253,38 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
       return False
     return True
 
+  def _get_class_attribute_names(self, cls):
+    """Get the attributes defined on a class or its bases."""
+    entry = self._class_attr_names_cache.get(id(cls))
+    if entry is None:
+      names = frozenset().union(*(c.get_own_attributes() for c in cls.mro
+                                  if isinstance(c, abstract.Class)))
+      entry = self._class_attr_names_cache[id(cls)] = (cls, names)
+    return entry[1]
+
   def _get_attribute_names(self, left):
     """Get the attributes implemented (or implicit) on a type."""
-    left_attributes = set()
+    left_attributes = self._get_class_attribute_names(left.cls)
     if isinstance(left, abstract.Module):
       _ = left.items()  # loads all attributes into members
-    if isinstance(left, abstract.SimpleValue):
-      left_attributes.update(left.members)
-    left_attributes.update(*(cls.get_own_attributes() for cls in left.cls.mro
-                             if isinstance(cls, abstract.Class)))
+    if isinstance(left, abstract.SimpleValue) and left.members:
+      left_attributes = left_attributes.union(left.members)
     if "__getitem__" in left_attributes and "__iter__" not in left_attributes:
       # If a class has a __getitem__ method, it also (implicitly) has a
       # __iter__: Python will emulate __iter__ by calling __getitem__ with
       # increasing integers until it throws IndexError.
-      left_attributes.add("__iter__")
+      left_attributes = left_attributes | {"__iter__"}
     return left_attributes
 
+  def _get_sorted_protocol_attributes(self, protocol):
+    """Get the protocol's attributes as a sorted tuple."""
+    entry = self._sorted_protocol_attributes.get(id(protocol))
+    if entry is None or entry[1] is not protocol.protocol_attributes:
+      entry = self._sorted_protocol_attributes[id(protocol)] = (
+          protocol, protocol.protocol_attributes,
+          tuple(sorted(protocol.protocol_attributes)))
+    return entry[2]
+
   def _match_against_protocol(self, left, other_type, subst, view):
     """Checks whether a type is compatible with a protocol.
 
@@ -1041,22 +1300,40 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
       return subst
     elif left.cls.is_dynamic:
       return self._subst_with_type_parameters_from(subst, other_type)
+    missing_key = (id(left), id(other_type))
+    entry = self._protocol_missing_cache.get(missing_key)
+    if entry is not None:
+      self._protocol_error = entry[2]
+      return None
     left_attributes = self._get_attribute_names(left)
-    missing = other_type.protocol_attributes - left_attributes
-    if missing:  # not all protocol attributes are implemented by 'left'
+    if not other_type.protocol_attributes <= left_attributes:
+      # not all protocol attributes are implemented by 'left'
+      missing = other_type.protocol_attributes - left_attributes
       self._protocol_error = ProtocolMissingAttributesError(
           left.cls, other_type, missing)
+      self._protocol_missing_cache[missing_key] = (
+          left, other_type, self._protocol_error)
       return None
     key = (left.cls, other_type)
     if key in self._protocol_cache:
       return subst
-    self._protocol_cache.add(key)
+    self._protocol_cache[key] = None
+    failed_key = (id(left.cls), id(other_type))
+    attributes = self._get_sorted_protocol_attributes(other_type)
+    failed = self._failed_protocol_attributes.get(failed_key)
+    if failed is not None:
+      # Check the attribute that made the last match fail first, so that a
+      # repeated failure is usually detected after a single attribute.
+      attributes = (failed[2],) + tuple(
+          a for a in attributes if a != failed[2])
     new_substs = []
-    for attribute in other_type.protocol_attributes:
+    for attribute in attributes:
       new_subst = self._match_protocol_attribute(
           left, other_type, attribute, subst, view)
       if new_subst is None:
         # _match_protocol_attribute already set _protocol_error.
+        self._failed_protocol_attributes[failed_key] = (
+            left.cls, other_type, attribute)
         return None
       new_substs.append(new_subst)
     return self._merge_substs(subst, new_substs)
@@ -1097,7 +1374,11 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
     parameters = {}
     for param in cls.template:
       param_value = value.get_instance_type_parameter(param.name)
-      types = list(filter(None, (self._get_type(v) for v in param_value.data)))
+      types = []
+      for v in param_value.data:
+        typ = self._get_type(v)
+        if typ:
+          types.append(typ)
       if not types:
         break
       parameters[param.name] = self.ctx.convert.merge_values(types)
@@ -1115,7 +1396,7 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
         yield typ
       return
     converter = self.ctx.pytd_convert
-    for signature in function.get_signatures(attribute):
+    for signature in self._get_signatures(attribute):
       callable_signature = converter.signature_to_callable(signature)
       if isinstance(callable_signature, abstract.CallableClass):
         # Prevent the matcher from trying to enforce contravariance on 'self'.
@@ -1133,6 +1414,15 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
             self._node, callable_signature, [annotation_subst])
       yield callable_signature
 
+  def _get_cached_attribute_types(self, other_type, attribute):
+    """Memoized, list-returning version of _get_attribute_types."""
+    key = (id(other_type), id(attribute))
+    entry = self._attribute_types_cache.get(key)
+    if entry is None:
+      types = list(self._get_attribute_types(other_type, attribute))
+      entry = self._attribute_types_cache[key] = (other_type, attribute, types)
+    return entry[2]
+
   def _match_protocol_attribute(self, left, other_type, attribute, subst, view):
     """Checks whether left and other_type are compatible in the given attribute.
 
@@ -1169,15 +1459,15 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
     # Every binding of left_attribute needs to match at least one binding of
     # protocol_attribute_var.
     new_substs = []
-    for new_view in abstract_utils.get_views([left_attribute], self._node):
+    for new_view in self._get_views(left_attribute):
       new_view.update(view)
       bad_matches = []
       for protocol_attribute in protocol_attribute_var.data:
         # For this binding of left_attribute to match this binding of
         # protocol_attribute_var, *all* options in protocol_attribute_types need
         # to match.
-        protocol_attribute_types = list(
-            self._get_attribute_types(other_type, protocol_attribute))
+        protocol_attribute_types = self._get_cached_attribute_types(
+            other_type, protocol_attribute)
         for protocol_attribute_type in protocol_attribute_types:
           match_result = self.match_var_against_type(
               left_attribute, protocol_attribute_type, subst, new_view)
@@ -1195,25 +1485,12 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
         # protocol_attribute_var.
         bad_left, bad_right = zip(*bad_matches)
         self._protocol_error = ProtocolTypeError(
-            left.cls, other_type, attribute,
-            self.ctx.convert.merge_values(bad_left),
-            self.ctx.convert.merge_values(bad_right))
+            left.cls, other_type, attribute, bad_left, bad_right)
         return None
     return self._merge_substs(subst, new_substs)
 
   def _discard_ambiguous_values(self, values):
-    # TODO(rechen): For type parameter instances, we should extract the concrete
-    # value from v.instance so that we can check it, rather than ignoring the
-    # value altogether.
-    concrete_values = []
-    for v in values:
-      # TODO(b/200220895): This is probably wrong; we should expand unions
-      # instead of ignoring them.
-      if not isinstance(v, (abstract.AMBIGUOUS_OR_EMPTY, abstract.Union,
-                            abstract.TypeParameterInstance)):
-        if not isinstance(v.cls, abstract.AMBIGUOUS_OR_EMPTY):
-          concrete_values.append(v)
-    return concrete_values
+    return [v for v in values if _is_concrete_value(v)]
 
   def _satisfies_single_type(self, values):
     """Enforce that the variable contains only one concrete type."""
@@ -1224,50 +1501,75 @@ class AbstractMatcher(utils.ContextWeakrefMixin):
     # We require all occurrences to be of the same type, no subtyping allowed.
     return len(class_names) <= 1
 
-  def _satisfies_common_superclass(self, values):
-    """Enforce that the variable's values share a superclass below object."""
-    common_classes = None
-    object_in_values = False
-    for v in values:
-      object_in_values |= v.cls == self.ctx.convert.object_type
-      superclasses = {c.full_name for c in v.cls.mro}
+  def _get_superclass_names(self, cls):
+    """Get cls's superclass names, expanded with compatible builtins."""
+    entry = self._superclass_names_cache.get(id(cls))
+    if entry is None:
+      superclasses = {c.full_name for c in cls.mro}
       for compat_name, name in _COMPATIBLE_BUILTINS:
         if compat_name in superclasses:
           superclasses.add(name)
-      if common_classes is None:
-        common_classes = superclasses
-      else:
-        common_classes = common_classes.intersection(superclasses)
+      entry = self._superclass_names_cache[id(cls)] = (
+          cls, frozenset(superclasses))
+    return entry[1]
+
+  def _satisfies_common_superclass(self, values):
+    """Enforce that the variable's values share a superclass below object."""
+    if not values:
+      return True
+    object_type = self.ctx.convert.object_type
+    object_in_values = values[0].cls == object_type
+    common_classes = self._get_superclass_names(values[0].cls)
+    for v in values[1:]:
+      object_in_values |= v.cls == object_type
+      common_classes = common_classes & self._get_superclass_names(v.cls)
     if object_in_values:
       ignored_superclasses = {}
     else:
       ignored_superclasses = {"builtins.object",
                               "typing.Generic",
                               "typing.Protocol"}
-    if values:
-      assert common_classes is not None
-      if common_classes.issubset(ignored_superclasses):
-        return False
-    return True
+    return not common_classes.issubset(ignored_superclasses)
 
   def _satisfies_noniterable_str(self, left, other_type):
     """Enforce a str to NOT be matched against a conflicting iterable type."""
-    conflicting_iter_types = ["typing.Iterable", "typing.Sequence",
-                              "typing.Collection", "typing.Container",]
-    str_types = ["builtins.str", "builtins.unicode",]
-
-    if (other_type.full_name not in conflicting_iter_types
-        or left.full_name not in str_types):
+    if (other_type.full_name not in _CONFLICTING_ITER_TYPE_NAMES
+        or left.full_name not in _STR_TYPE_NAMES):
       return True  # Reject uninterested type combinations
     if isinstance(other_type, abstract.ParameterizedClass):
       type_param = other_type.get_formal_type_parameter("_T").full_name
-      return type_param not in str_types
+      return type_param not in _STR_TYPE_NAMES
 
     return True  # Don't enforce against Iterable[Any]
 
   def _subst_with_type_parameters_from(self, subst, typ):
-    subst = subst.copy()
-    for param in self.ctx.annotation_utils.get_type_parameters(typ):
-      if param.name not in subst:
-        subst[param.name] = self.ctx.convert.empty.to_variable(self._node)
-    return subst
+    new_subst = subst
+    for param in self._get_type_parameters(typ):
+      if param.name not in new_subst:
+        if new_subst is subst:
+          new_subst = subst.copy()
+        new_subst[param.name] = self.ctx.convert.empty.to_variable(self._node)
+    return new_subst
+
+
+# Matchers for _match_type_against_type, keyed by the type of the value on the
+# left. The first entry whose types include the value's class is used, so more
+# specific types have to come first.
+_LEFT_MATCHERS = (
+    (abstract.AMBIGUOUS_OR_EMPTY,
+     AbstractMatcher._match_ambiguous_against_type),
+    (abstract.Class, AbstractMatcher._match_class_against_type),
+    (abstract.Module, AbstractMatcher._match_module_against_type),
+    (abstract.FUNCTION_TYPES, AbstractMatcher._match_function_against_type),
+    (dataclass_overlay.FieldInstance,
+     AbstractMatcher._match_field_against_type),
+    (abstract.SimpleValue, AbstractMatcher._match_instance_against_type),
+    (special_builtins.SuperInstance, AbstractMatcher._match_super_against_type),
+    (abstract.ClassMethod, AbstractMatcher._match_classmethod_against_type),
+    (abstract.StaticMethod, AbstractMatcher._match_staticmethod_against_type),
+    (abstract.Union, AbstractMatcher._match_union_against_type),
+    (abstract.TypeParameterInstance,
+     AbstractMatcher._match_type_param_instance_against_type),
+)
+# Maps the class of a value to its matcher from _LEFT_MATCHERS, or None.
+_LEFT_MATCHER_CACHE = {}
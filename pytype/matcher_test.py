@@ -474,6 +474,26 @@ class MatcherTest(MatcherTestBase):
         }, self.ctx)
     self.assertNoMatch(left, right)
 
+  def test_renamed_type_parameter(self):
+    # Mimics `class Foo(List[U])`: the instance stores its value under Foo's
+    # renamed parameter rather than under list's own _T.
+    renamed = abstract.TypeParameter("U", self.ctx, module="foo.Foo")
+    cls = abstract.ParameterizedClass(
+        self.ctx.convert.list_type, {abstract_utils.T: renamed}, self.ctx)
+    left = abstract.Instance(cls, self.ctx)
+    param = self.ctx.convert.primitive_class_instances[int].to_variable(
+        self.ctx.root_node)
+    left.merge_instance_type_parameter(
+        self.ctx.root_node, renamed.full_name, param)
+    var = left.to_variable(self.ctx.root_node)
+    view = {var: var.bindings[0], param: param.bindings[0]}
+    for param_type, expected in ((self.ctx.convert.int_type, {}),
+                                 (self.ctx.convert.str_type, None)):
+      right = abstract.ParameterizedClass(
+          self.ctx.convert.list_type, {abstract_utils.T: param_type}, self.ctx)
+      self.assertEqual(
+          self.matcher.match_var_against_type(var, right, {}, view), expected)
+
 
 class TypeVarTest(MatcherTestBase):
   """Test matching TypeVar against various types."""
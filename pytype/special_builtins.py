@@ -1,14 +1,37 @@
 """Custom implementations of builtin types."""
 
+from pytype import datatypes
 from pytype.abstract import abstract
 from pytype.abstract import abstract_utils
 from pytype.abstract import function
 from pytype.abstract import mixin
 
+# Arguments for calling a method with no arguments. The instance is shared, so
+# its namedargs are an ImmutableDict; Args() would replace an empty one with {}.
+_EMPTY_ARGS = function.Args(()).replace(namedargs=datatypes.ImmutableDict())
+
+
+def _all_protocol(values):
+  """Whether all values are typing.Protocol."""
+  if len(values) == 1:  # fast path for the common case
+    return values[0].full_name == "typing.Protocol"
+  return all(v.full_name == "typing.Protocol" for v in values)
+
 
 class TypeNew(abstract.PyTDFunction):
   """Implements type.__new__."""
 
+  def __init__(self, name, signatures, kind, ctx):
+    super().__init__(name, signatures, kind, ctx)
+    self._abcmeta = None  # the abc.ABCMeta variable, loaded on first use
+
+  def _get_abcmeta(self):
+    if self._abcmeta is None:
+      abc = self.ctx.vm.import_module("abc", "abc", 0).get_module("ABCMeta")
+      abc.load_lazy_attribute("ABCMeta")
+      self._abcmeta = abc.members["ABCMeta"]
+    return self._abcmeta
+
   def call(self, node, func, args):
     if len(args.posargs) == 4:
       self.match_args(node, args)  # May raise FailedFunctionCall.
@@ -37,22 +60,21 @@ class TypeNew(abstract.PyTDFunction):
       # bound to a class or function, so we'll go with Any.
       self.match_args(node, args)  # May raise FailedFunctionCall.
       return node, self.ctx.new_unsolvable(node)
-    elif args.posargs and all(
-        v.full_name == "typing.Protocol" for v in args.posargs[-1].data):
+    elif args.posargs and _all_protocol(args.posargs[-1].data):
       # type(Protocol) is a _ProtocolMeta class that inherits from abc.ABCMeta.
       # Changing the definition of Protocol in typing.pytd to include this
       # metaclass causes a bunch of weird breakages, so we instead return the
       # metaclass when type() or __class__ is accessed on Protocol. For
       # simplicity, we pretend the metaclass is ABCMeta rather than a subclass.
       self.match_args(node, args)  # May raise FailedFunctionCall.
-      abc = self.ctx.vm.import_module("abc", "abc", 0).get_module("ABCMeta")
-      abc.load_lazy_attribute("ABCMeta")
-      return node, abc.members["ABCMeta"].AssignToNewVariable(node)
+      return node, self._get_abcmeta().AssignToNewVariable(node)
     node, raw_ret = super().call(node, func, args)
     # Removes TypeVars from the return value.
     ret = self.ctx.program.NewVariable()
     for b in raw_ret.bindings:
-      value = self.ctx.annotation_utils.deformalize(b.data)
+      value = b.data
+      if value.formal:
+        value = self.ctx.annotation_utils.deformalize(value)
       ret.AddBinding(value, {b}, node)
     return node, ret
 
@@ -77,8 +99,17 @@ class BuiltinFunction(abstract.PyTDFunction):
 
   def get_underlying_method(self, node, receiver, method_name):
     """Get the bound method that a built-in function delegates to."""
+    bindings = receiver.bindings
+    if len(bindings) == 1:
+      # Fast path: with a single method, the join is a copy of it.
+      b, = bindings
+      node, result = self.ctx.attribute_handler.get_attribute(
+          node, b.data, method_name, valself=b)
+      if result is not None:
+        result = result.AssignToNewVariable(node)
+      return node, result
     results = []
-    for b in receiver.bindings:
+    for b in bindings:
       node, result = self.ctx.attribute_handler.get_attribute(
           node, b.data, method_name, valself=b)
       if result is not None:
@@ -107,7 +138,7 @@ class Abs(BuiltinFunction):
     arg = args.posargs[0]
     node, fn = self.get_underlying_method(node, arg, "__abs__")
     if fn is not None:
-      return function.call_function(self.ctx, node, fn, function.Args(()))
+      return function.call_function(self.ctx, node, fn, _EMPTY_ARGS)
     else:
       return node, self.ctx.new_unsolvable(node)
 
@@ -124,7 +155,7 @@ class Next(BuiltinFunction):
     elif "default" in args.namedargs:
       default = args.namedargs["default"]
     else:
-      default = self.ctx.program.NewVariable()
+      default = None
     return arg, default
 
   def call(self, node, _, args):
@@ -132,8 +163,9 @@ class Next(BuiltinFunction):
     arg, default = self._get_args(args)
     node, fn = self.get_underlying_method(node, arg, "__next__")
     if fn is not None:
-      node, ret = function.call_function(self.ctx, node, fn, function.Args(()))
-      ret.PasteVariable(default)
+      node, ret = function.call_function(self.ctx, node, fn, _EMPTY_ARGS)
+      if default is not None:
+        ret.PasteVariable(default)
       return node, ret
     else:
       return node, self.ctx.new_unsolvable(node)
@@ -183,10 +215,11 @@ class UnaryPredicate(ObjectPredicate):
     raise NotImplementedError(self.__class__.__name__)
 
   def run(self, node, args, result):
+    vm_values = self._vm_values
+    add_binding = result.AddBinding
     for obj in args.posargs[0].bindings:
       node, pyval = self._call_predicate(node, obj)
-      result.AddBinding(self._vm_values[pyval],
-                        source_set=(obj,), where=node)
+      add_binding(vm_values[pyval], source_set=(obj,), where=node)
 
 
 class BinaryPredicate(ObjectPredicate):
@@ -197,17 +230,53 @@ class BinaryPredicate(ObjectPredicate):
   _call_predicate(self, node, left, right): The implementation of the predicate.
   """
 
+  def __init__(self, name, signatures, kind, ctx):
+    super().__init__(name, signatures, kind, ctx)
+    # Maps (id(class), id(class spec)) to (class, class spec, result of
+    # check_against_mro), for class specs that are single classes.
+    self._mro_check_cache = {}
+
   def _call_predicate(self, node, left, right):
     raise NotImplementedError(self.__class__.__name__)
 
+  def _check_against_mro(self, cls, class_spec):
+    """Memoized version of abstract_utils.check_against_mro."""
+    if not isinstance(cls, abstract.Class) or not isinstance(
+        class_spec, abstract.Class):
+      # Other class specs, such as tuples, may contain variables that gain
+      # bindings later on, so the result cannot be reused.
+      return abstract_utils.check_against_mro(self.ctx, cls, class_spec)
+    key = (id(cls), id(class_spec))
+    entry = self._mro_check_cache.get(key)
+    if entry is None:
+      entry = self._mro_check_cache[key] = (
+          cls, class_spec,
+          abstract_utils.check_against_mro(self.ctx, cls, class_spec))
+    return entry[2]
+
   def run(self, node, args, result):
-    for left in abstract_utils.expand_type_parameter_instances(
-        args.posargs[0].bindings):
-      for right in abstract_utils.expand_type_parameter_instances(
-          args.posargs[1].bindings):
+    left_bindings = args.posargs[0].bindings
+    right_bindings = args.posargs[1].bindings
+    if (len(left_bindings) == 1 and len(right_bindings) == 1 and
+        not isinstance(left_bindings[0].data, abstract.TypeParameterInstance)
+        and not isinstance(
+            right_bindings[0].data, abstract.TypeParameterInstance)):
+      # Fast path for the common case of a single value on each side, e.g.
+      # isinstance(x, int) with a single possible x.
+      left, = left_bindings
+      right, = right_bindings
+      node, pyval = self._call_predicate(node, left, right)
+      result.AddBinding(self._vm_values[pyval],
+                        source_set=(left, right), where=node)
+      return
+    right_bindings = list(
+        abstract_utils.expand_type_parameter_instances(right_bindings))
+    vm_values = self._vm_values
+    add_binding = result.AddBinding
+    for left in abstract_utils.expand_type_parameter_instances(left_bindings):
+      for right in right_bindings:
         node, pyval = self._call_predicate(node, left, right)
-        result.AddBinding(self._vm_values[pyval],
-                          source_set=(left, right), where=node)
+        add_binding(vm_values[pyval], source_set=(left, right), where=node)
 
 
 class HasAttr(BinaryPredicate):
@@ -232,7 +301,7 @@ class HasAttr(BinaryPredicate):
       (node, result) where result = True if the object has attribute attr, False
       if it does not, and None if it is ambiguous.
     """
-    if isinstance(obj, abstract.AMBIGUOUS_OR_EMPTY):
+    if obj.is_ambiguous_or_empty:
       return node, None
     # If attr is not a literal constant, don't try to resolve it.
     if (not isinstance(attr, mixin.PythonConstant) or
@@ -264,10 +333,9 @@ class IsInstance(BinaryPredicate):
       it is not, and None if it is ambiguous whether obj matches class_spec.
     """
     cls = obj.cls
-    if (isinstance(obj, abstract.AMBIGUOUS_OR_EMPTY) or
-        isinstance(cls, abstract.AMBIGUOUS_OR_EMPTY)):
+    if obj.is_ambiguous_or_empty or cls.is_ambiguous_or_empty:
       return None
-    return abstract_utils.check_against_mro(self.ctx, cls, class_spec)
+    return self._check_against_mro(cls, class_spec)
 
 
 class IsSubclass(BinaryPredicate):
@@ -290,10 +358,10 @@ class IsSubclass(BinaryPredicate):
       if not, and None if it is ambiguous.
     """
 
-    if isinstance(cls, abstract.AMBIGUOUS_OR_EMPTY):
+    if cls.is_ambiguous_or_empty:
       return None
 
-    return abstract_utils.check_against_mro(self.ctx, cls, class_spec)
+    return self._check_against_mro(cls, class_spec)
 
 
 class IsCallable(UnaryPredicate):
@@ -319,7 +387,7 @@ class IsCallable(UnaryPredicate):
     # longer consider calling matcher._match_value_against_type(obj,
     # convert.callable) instead.
     val = obj.data
-    if isinstance(val, abstract.AMBIGUOUS_OR_EMPTY):
+    if val.is_ambiguous_or_empty:
       return node, None
     # Classes are always callable.
     if isinstance(val, abstract.Class):
@@ -355,15 +423,29 @@ class SuperInstance(abstract.BaseValue):
     self.cls = self.ctx.convert.super_type
     self.super_cls = cls
     self.super_obj = obj
-    self.get = abstract.NativeFunction("__get__", self.get, self.ctx)
+    self._get = None
+
+  @property
+  def get(self):
+    # Only needed when no superclass provides __get__, so build it on demand.
+    if self._get is None:
+      self._get = abstract.NativeFunction("__get__", self._get_impl, self.ctx)
+    return self._get
 
-  def get(self, node, *unused_args, **unused_kwargs):
+  def _get_impl(self, node, *unused_args, **unused_kwargs):
     return node, self.to_variable(node)
 
   def _get_descriptor_from_superclass(self, node, cls):
     obj = cls.instantiate(node)
+    bindings = obj.bindings
+    if len(bindings) == 1:
+      # Fast path: with a single descriptor, the join is a copy of it.
+      b, = bindings
+      _, attr = self.ctx.attribute_handler.get_attribute(
+          node, b.data, "__get__", valself=b)
+      return attr.AssignToNewVariable(node) if attr else None
     ret = []
-    for b in obj.bindings:
+    for b in bindings:
       _, attr = self.ctx.attribute_handler.get_attribute(
           node, b.data, "__get__", valself=b)
       if attr:
@@ -397,6 +479,17 @@ class Super(BuiltinClass):
 
   def __init__(self, ctx):
     super().__init__(ctx, "super")
+    # Maps (id(cls), id(obj)) to the SuperInstance for that pair. SuperInstance
+    # carries no mutable state, so one proxy can be shared by all call sites.
+    self._instances = {}
+
+  def _get_instance(self, cls, obj):
+    key = (id(cls), id(obj))
+    instance = self._instances.get(key)
+    if instance is None:
+      # The instance keeps references to cls and obj, so the ids stay valid.
+      instance = self._instances[key] = SuperInstance(cls, obj, self.ctx)
+    return instance
 
   def call(self, node, _, args):
     result = self.ctx.program.NewVariable()
@@ -409,10 +502,10 @@ class Super(BuiltinClass):
       while self.ctx.vm.frames[index].f_code.co_name == "<listcomp>":
         index -= 1
       frame = self.ctx.vm.frames[index]
-      for i, free_var in enumerate(frame.f_code.co_freevars):
-        if free_var == abstract.BuildClass.CLOSURE_NAME:
-          cls_var = frame.cells[len(frame.f_code.co_cellvars) + i]
-          break
+      f_code = frame.f_code
+      if abstract.BuildClass.CLOSURE_NAME in f_code.co_freevars:
+        i = f_code.co_freevars.index(abstract.BuildClass.CLOSURE_NAME)
+        cls_var = frame.cells[len(f_code.co_cellvars) + i]
       if not (cls_var and cls_var.bindings):
         self.ctx.errorlog.invalid_super_call(
             self.ctx.vm.frames,
@@ -442,10 +535,9 @@ class Super(BuiltinClass):
       for obj in super_objects:
         if obj:
           result.AddBinding(
-              SuperInstance(cls.data, obj.data, self.ctx), [cls, obj], node)
+              self._get_instance(cls.data, obj.data), [cls, obj], node)
         else:
-          result.AddBinding(
-              SuperInstance(cls.data, None, self.ctx), [cls], node)
+          result.AddBinding(self._get_instance(cls.data, None), [cls], node)
     return node, result
 
 
@@ -454,6 +546,17 @@ class Object(BuiltinClass):
 
   def __init__(self, ctx):
     super().__init__(ctx, "object")
+    # Maps a member name to the member's data, for the members that are
+    # compared against in is_object_new and _has_own. builtins.object is never
+    # modified, so the data can be loaded once.
+    self._member_data = {}
+
+  def _get_member_data(self, name):
+    data = self._member_data.get(name)
+    if data is None:
+      self.load_lazy_attribute(name)
+      data = self._member_data[name] = self.members[name].data
+    return data
 
   def is_object_new(self, func):
     """Whether the given function is object.__new__.
@@ -465,10 +568,8 @@ class Object(BuiltinClass):
       True if func equals either of the pytd definitions for object.__new__,
       False otherwise.
     """
-    self.load_lazy_attribute("__new__")
-    self.load_lazy_attribute("__new__extra_args")
-    return ([func] == self.members["__new__"].data or
-            [func] == self.members["__new__extra_args"].data)
+    return ([func] == self._get_member_data("__new__") or
+            [func] == self._get_member_data("__new__extra_args"))
 
   def _has_own(self, node, cls, method):
     """Whether a class has its own implementation of a particular method.
@@ -486,10 +587,8 @@ class Object(BuiltinClass):
     assert method in ("__new__", "__init__")
     if not isinstance(cls, abstract.Class):
       return False
-    self.load_lazy_attribute(method)
-    obj_method = self.members[method]
     _, cls_method = self.ctx.attribute_handler.get_attribute(node, cls, method)
-    return obj_method.data != cls_method.data
+    return self._get_member_data(method) != cls_method.data
 
   def get_special_attribute(self, node, name, valself):
     # Based on the definitions of object_init and object_new in
@@ -545,6 +644,7 @@ class PropertyTemplate(BuiltinClass):
   """Template for property decorators."""
 
   _KEYS = ["fget", "fset", "fdel", "doc"]
+  _KEY_SET = frozenset(_KEYS)
 
   def __init__(self, ctx, name, module="builtins"):  # pylint: disable=useless-super-delegation
     super().__init__(ctx, name, module)
@@ -554,9 +654,11 @@ class PropertyTemplate(BuiltinClass):
     return function.Signature.from_param_names(self.name, tuple(self._KEYS))
 
   def _get_args(self, args):
-    ret = dict(zip(self._KEYS, args.posargs))
+    posargs = args.posargs
+    keys = self._KEYS
+    ret = {keys[i]: posargs[i] for i in range(min(len(posargs), len(keys)))}
     for k, v in args.namedargs.items():
-      if k not in self._KEYS:
+      if k not in self._KEY_SET:
         raise function.WrongKeywordArgs(self.signature(), args, self.ctx, [k])
       ret[k] = v
     return ret
@@ -568,7 +670,10 @@ class PropertyTemplate(BuiltinClass):
 def _is_fn_abstract(func_var):
   if func_var is None:
     return False
-  return any(getattr(d, "is_abstract", None) for d in func_var.data)
+  # Functions always carry is_abstract, so only other values (classes, which
+  # expose it as a property, or plain instances) need the getattr fallback.
+  return any(d.is_abstract if isinstance(d, abstract.Function)
+             else getattr(d, "is_abstract", False) for d in func_var.data)
 
 
 class PropertyInstance(abstract.Function, mixin.HasSlots):
@@ -605,23 +710,23 @@ class PropertyInstance(abstract.Function, mixin.HasSlots):
     return function.call_function(self.ctx, node, self.fdel,
                                   function.Args((obj,)))
 
+  def _replace_accessor(self, node, **accessor):
+    """Returns a copy of this property with one accessor replaced."""
+    fields = {"fget": self.fget, "fset": self.fset, "fdel": self.fdel,
+              "doc": self.doc}
+    fields.update(accessor)
+    prop = PropertyInstance(self.ctx, self.name, self.cls, **fields)
+    func, = accessor.values()
+    return node, self.ctx.program.NewVariable([prop], func.bindings, node)
+
   def getter_slot(self, node, fget):
-    prop = PropertyInstance(self.ctx, self.name, self.cls, fget, self.fset,
-                            self.fdel, self.doc)
-    result = self.ctx.program.NewVariable([prop], fget.bindings, node)
-    return node, result
+    return self._replace_accessor(node, fget=fget)
 
   def setter_slot(self, node, fset):
-    prop = PropertyInstance(self.ctx, self.name, self.cls, self.fget, fset,
-                            self.fdel, self.doc)
-    result = self.ctx.program.NewVariable([prop], fset.bindings, node)
-    return node, result
+    return self._replace_accessor(node, fset=fset)
 
   def deleter_slot(self, node, fdel):
-    prop = PropertyInstance(self.ctx, self.name, self.cls, self.fget, self.fset,
-                            fdel, self.doc)
-    result = self.ctx.program.NewVariable([prop], fdel.bindings, node)
-    return node, result
+    return self._replace_accessor(node, fdel=fdel)
 
 
 class Property(PropertyTemplate):
@@ -704,8 +809,12 @@ class ClassMethod(BuiltinClass):
       raise function.WrongArgCount(self._SIGNATURE, args, self.ctx)
     arg = args.posargs[0]
     for d in arg.data:
-      d.is_classmethod = True
-      d.is_attribute_of_class = True
+      # The same function may be wrapped repeatedly, e.g. when stubs are
+      # re-analyzed for subclasses, so skip the stores if it is already marked.
+      if not (getattr(d, "is_classmethod", False) and
+              getattr(d, "is_attribute_of_class", False)):
+        d.is_classmethod = True
+        d.is_attribute_of_class = True
     return node, ClassMethodInstance(self.ctx, self, arg).to_variable(node)
 
 
@@ -716,10 +825,12 @@ class Dict(BuiltinClass):
     super().__init__(ctx, "dict")
 
   def call(self, node, funcb, args):
-    if self.ctx.options.build_dict_literals_from_kwargs:
-      build_literal = not args.has_non_namedargs()
-    else:
-      build_literal = args.is_empty()
+    # Equivalent to `not args.has_non_namedargs()` when building literals from
+    # kwargs and to `args.is_empty()` otherwise, with the checks inlined.
+    build_literal = not (
+        args.posargs or args.starargs or args.starstarargs or
+        (not self.ctx.options.build_dict_literals_from_kwargs and
+         args.has_namedargs()))
     if build_literal:
       # special-case a dict constructor with explicit k=v args
       d = abstract.Dict(self.ctx)
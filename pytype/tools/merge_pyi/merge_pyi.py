@@ -38,14 +38,16 @@ argument of a class method:
 Finally, it knows that __init__() is supposed to return None.
 """
 
+import ast
 import collections
-import itertools
+import concurrent.futures
+import functools
 import logging
+import os
+import types
 
 from lib2to3 import pygram
 from lib2to3 import pytree
-# lib2to3.refactor is missing from typeshed
-from lib2to3 import refactor  # pytype: disable=import-error
 from lib2to3.fixer_base import BaseFix
 from lib2to3.fixer_util import does_tree_import
 from lib2to3.fixer_util import find_indentation
@@ -58,7 +60,8 @@ from lib2to3.pytree import Node
 
 __all__ = ['KnownError',
            'FixMergePyi',
-           'annotate_string']
+           'annotate_string',
+           'annotate_strings']
 
 
 def patch_grammar(grammar_file):
@@ -78,8 +81,6 @@ class KnownError(Exception):
 class Util:
   """Utility functions for working with Nodes."""
 
-  return_expr = compile_pattern("""return_stmt< 'return' any >""")
-
   @classmethod
   def has_return_exprs(cls, node):
     """Traverse the tree below node looking for 'return expr'.
@@ -88,15 +89,17 @@ class Util:
       node: The AST node at the root of the subtree.
 
     Returns:
-      True if 'return' or 'return expr' is found, False otherwise.
+      True if 'return expr' is found, False otherwise.
     """
-    results = {}
-    if cls.return_expr.match(node, results):
-      return True
-    for child in node.children:
-      if child.type not in (syms.funcdef, syms.classdef):
-        if cls.has_return_exprs(child):
-          return True
+    # A bare 'return' is a Leaf, so any return_stmt has an expression.
+    stack = [node]
+    while stack:
+      node = stack.pop()
+      if node.type == syms.return_stmt:
+        return True
+      for child in node.children:
+        if child.type not in (syms.funcdef, syms.classdef):
+          stack.append(child)
     return False
 
   driver = driver.Driver(
@@ -120,11 +123,15 @@ class Util:
 class ArgSignature:
   """Partially parsed representation of a function argument."""
 
+  __slots__ = ('_is_tuple', '_stars', '_arg_type', '_name_nodes', '_default',
+               '_was_modified', '_arg_type_str')
+
   def __init__(self, arg_nodes):
     sig = ArgSignature._split_arg(arg_nodes)
     (self._is_tuple, self._stars, self._arg_type, self._name_nodes,
      self._default) = sig
     self._was_modified = False
+    self._arg_type_str = None
 
   @property
   def is_tuple(self):
@@ -141,6 +148,15 @@ class ArgSignature:
     """Existing annotation: (Node|Leaf|None)."""
     return self._arg_type
 
+  @property
+  def arg_type_str(self):
+    """Existing annotation as a single-line string, or None."""
+    if self._arg_type_str is None and self.arg_type:
+      self._arg_type_str = ''.join(
+          ', ' if n.type == token.COMMA else n.value
+          for n in self.arg_type.leaves()).strip()
+    return self._arg_type_str
+
   @property
   def default(self):
     """Node holding default value or None."""
@@ -202,17 +218,43 @@ class ArgSignature:
 
     # [('*'|'**')] (NAME | packed_tuple) [':' test] ['=' test]
 
+    # Find the stars, colon and equals sign in a single pass.
+    star_idx = colon_idx = eq_idx = None
+    for i, n in enumerate(arg):
+      if not is_leaf(n):
+        continue
+      if n.value in ('*', '**'):
+        assert star_idx is None
+        star_idx = i
+      elif n.value == ':':
+        assert colon_idx is None
+        colon_idx = i
+      elif n.value == '=':
+        assert eq_idx is None
+        eq_idx = i
+
+    start, end = 0, len(arg)
+
     # Strip stars
-    idx = get_unique_idx(arg, ['*', '**'])
-    if idx is not None:
-      assert idx == 0
-      stars = arg.pop(idx).value
+    if star_idx is not None:
+      assert star_idx == 0
+      stars = arg[star_idx].value
+      start = 1
 
     # Strip default
-    idx = get_unique_idx(arg, '=')
-    if idx is not None:
-      assert idx == (len(arg) - 2)
-      arg, default = arg[:idx], arg[idx + 1]
+    if eq_idx is not None:
+      assert eq_idx == end - 2
+      default = arg[eq_idx + 1]
+      end = eq_idx
+
+    # Strip one flavor of arg_type (the other flavor, where we have a tname
+    # Node, is handled below)
+    if colon_idx is not None:
+      assert colon_idx == end - 2
+      arg_type = arg[colon_idx + 1]
+      end = colon_idx
+
+    arg = arg[start:end]
 
     def split_colon(nodes):
       idx = get_unique_idx(nodes, ':')
@@ -221,10 +263,6 @@ class ArgSignature:
       assert idx == (len(nodes) - 2)
       return nodes[:idx], nodes[idx + 1]
 
-    # Strip one flavor of arg_type (the other flavor, where we have a tname
-    # Node, is handled below)
-    arg, arg_type = split_colon(arg)
-
     if len(arg) == 3:
       assert arg[0].type == token.LPAR
       assert arg[2].type == token.RPAR
@@ -284,6 +322,11 @@ class ArgSignature:
 class FuncSignature:
   """A function or method."""
 
+  __slots__ = ('_short_name', '_ret_type', '_full_name', '_arg_sigs',
+               '_arg_stars', '_node', '_match_results',
+               '_inserted_ret_annotation', '_ret_type_str', '_decorators',
+               '_is_method', '_has_return_exprs')
+
   _full_name: str
 
   # The pattern to match.
@@ -295,23 +338,39 @@ class FuncSignature:
                 colon=':' suite=any+ >
               """
 
-  def __init__(self, node, match_results):
-    """node must match PATTERN."""
+  def __init__(self, node, match_results, key_cache=None):
+    """node must match PATTERN.
+
+    Args:
+      node: The funcdef node.
+      match_results: The results of matching node against PATTERN.
+      key_cache: Optionally, a dict shared by the FuncSignatures of one tree
+        that caches the keys of enclosing scopes. See _make_function_key.
+    """
 
     name = match_results.get('name')
     assert isinstance(name, Leaf), repr(name)
     assert name.type == token.NAME, repr(name)
 
+    self._short_name = name.value
     self._ret_type = match_results.get('ret_annotation')
-    self._full_name = self._make_function_key(name)
+    self._full_name = self._make_function_key(name, key_cache)
 
-    args = self._split_args(match_results.get('args'))
-    self._arg_sigs = tuple(map(ArgSignature, args))
+    # The arguments are parsed on first use, since most functions in a large
+    # pyi are never looked up.
+    self._arg_sigs = None
+    self._arg_stars = None
 
     self._node = node
     self._match_results = match_results
     self._inserted_ret_annotation = False
 
+    # Computed on first access, since each of these walks the tree.
+    self._ret_type_str = None
+    self._decorators = None
+    self._is_method = None
+    self._has_return_exprs = None
+
   def __str__(self):
     return self.full_name
 
@@ -322,18 +381,40 @@ class FuncSignature:
 
   @property
   def short_name(self):
-    return self._match_results.get('name').value
+    return self._short_name
 
   @property
   def ret_type(self):
     """Return type, Node? or None."""
     return self._ret_type
 
+  @property
+  def ret_type_str(self):
+    """Return type as a string, or None."""
+    if self._ret_type_str is None and self.ret_type:
+      self._ret_type_str = str(self.ret_type).strip()
+    return self._ret_type_str
+
   @property
   def arg_sigs(self):
     """List[ArgSignature]."""
+    if self._arg_sigs is None:
+      self._parse_args()
     return self._arg_sigs
 
+  @property
+  def arg_stars(self):
+    """The stars of each argument, or None if any argument is a packed tuple."""
+    if self._arg_sigs is None:
+      self._parse_args()
+    return self._arg_stars
+
+  def _parse_args(self):
+    args = self._split_args(self._match_results.get('args'))
+    self._arg_sigs = tuple(map(ArgSignature, args))
+    if not any(arg.is_tuple for arg in self._arg_sigs):
+      self._arg_stars = tuple(arg.stars for arg in self._arg_sigs)
+
   # The parse tree has a different shape when there is a single
   # decorator vs. when there are multiple decorators.
   decorated_pattern = compile_pattern("""
@@ -353,6 +434,11 @@ class FuncSignature:
       decorators (e.g. @staticmethod) are returned. If the function is not
       decorated or only non-simple decorators are found, return [].
     """
+    if self._decorators is None:
+      self._decorators = self._get_decorators()
+    return self._decorators
+
+  def _get_decorators(self):
     node = self._node
     if node.parent is None:
       return []
@@ -370,6 +456,11 @@ class FuncSignature:
   @property
   def is_method(self):
     """Whether we are (directly) inside a class."""
+    if self._is_method is None:
+      self._is_method = self._get_is_method()
+    return self._is_method
+
+  def _get_is_method(self):
     node = self._node.parent
     while node is not None:
       if node.type == syms.classdef:
@@ -382,7 +473,9 @@ class FuncSignature:
   @property
   def has_return_exprs(self):
     """True if function has "return expr" anywhere."""
-    return Util.has_return_exprs(self._node)
+    if self._has_return_exprs is None:
+      self._has_return_exprs = Util.has_return_exprs(self._node)
+    return self._has_return_exprs
 
   @property
   def has_pep484_annotations(self):
@@ -400,12 +493,12 @@ class FuncSignature:
     return False
 
   def insert_ret_annotation(self, ret_type):
-    """In-place annotation. Can only be called once."""
+    """In-place annotation of ret_type, a string. Can only be called once."""
     assert not self._inserted_ret_annotation
     self._inserted_ret_annotation = True
 
     colon = self._match_results.get('colon')
-    colon.prefix = ' -> ' + str(ret_type).strip() + colon.prefix
+    colon.prefix = ' -> ' + ret_type + colon.prefix
 
   def try_insert_comment_annotation(self, annotation):
     """Try to insert '# type: {annotation}' comment."""
@@ -422,13 +515,12 @@ class FuncSignature:
     node.changed()
     return True
 
-  scope_pattern = compile_pattern("""(
-    funcdef < 'def'   name=TOKEN any*> |
-    classdef< 'class' name=TOKEN any*>
-    )""")
+  # Node types that contribute their name (always the second child, after
+  # 'def' or 'class') to a function key.
+  _SCOPE_TYPES = frozenset({syms.funcdef, syms.classdef})
 
   @classmethod
-  def _make_function_key(cls, node):
+  def _make_function_key(cls, node, cache=None):
     """Return the fully-qualified name of the function the node is under.
 
     If source is
@@ -442,19 +534,31 @@ class FuncSignature:
 
     Args:
       node: The node to start searching from.
+      cache: Optionally, a dict mapping id(scope node) to (scope node, key of
+        the scope). Scopes visited on the way up are added to it, and the walk
+        stops at the first scope that is already in it.
 
     Returns:
       The function key as a string.
     """
-    result = []
+    scopes = []
+    key = ''
     while node is not None:
-      match_result = {}
-      if cls.scope_pattern.match(node, match_result):
-        result.append(match_result['name'].value)
-
+      if node.type in cls._SCOPE_TYPES:
+        if cache is not None and id(node) in cache:
+          _, key = cache[id(node)]
+          break
+        scopes.append(node)
       node = node.parent
 
-    return '.'.join(reversed(result))
+    for scope in reversed(scopes):
+      name = scope.children[1].value
+      key = key + '.' + name if key else name
+      if cache is not None:
+        # Storing the node keeps it alive, so its id can't be reused.
+        cache[id(scope)] = (scope, key)
+
+    return key
 
   @staticmethod
   def _split_args(args):
@@ -492,14 +596,24 @@ class FixMergePyi(BaseFix):
 
   PATTERN = FuncSignature.PATTERN
 
+  # The (pattern, pattern_tree) pair compiled from PATTERN, shared by all
+  # instances since annotate_string() creates a new fixer for every call.
+  _compiled_pattern = None
+
   def __init__(self, options, log):
     super().__init__(options, log)
 
     # name -> FuncSignature map obtained from .pyi file
     self.pyi_funcs = None
 
+    # The last component of each name in pyi_funcs
+    self._pyi_short_names = frozenset()
+
     self.inserted_types = []
 
+    # Function key cache for the current tree; see FuncSignature.
+    self._key_cache = {}
+
     self.logger = logging.getLogger(self.__class__.__name__)
 
     # Options below
@@ -515,10 +629,31 @@ class FixMergePyi(BaseFix):
   def annotate_pep484(self, value):
     self._annotate_pep484 = bool(value)
 
+  def compile_pattern(self):
+    if FixMergePyi._compiled_pattern is None:
+      super().compile_pattern()
+      FixMergePyi._compiled_pattern = (self.pattern, self.pattern_tree)
+    else:
+      self.pattern, self.pattern_tree = FixMergePyi._compiled_pattern
+
+  def match(self, node):
+    # Functions whose name doesn't appear in the pyi can't be annotated. Unless
+    # we need to log why they are skipped, reject them before transform()
+    # builds a FuncSignature for them.
+    if (node.type == syms.funcdef and
+        node.children[1].value not in self._pyi_short_names and
+        not self.logger.isEnabledFor(logging.WARNING)):
+      return False
+    return super().match(node)
+
+  def start_tree(self, tree, filename):
+    super().start_tree(tree, filename)
+    self._key_cache = {}
+
   def transform(self, node, results):
     assert self.pyi_funcs is not None, 'must provide function annotations'
 
-    src_sig = FuncSignature(node, results)
+    src_sig = FuncSignature(node, results, self._key_cache)
     if not self.can_annotate(src_sig):
       return
     pyi_sig = self.pyi_funcs[src_sig.full_name]
@@ -540,7 +675,7 @@ class FixMergePyi(BaseFix):
       inserted_types.append(new_type)
 
     if pyi_sig.ret_type:
-      src_sig.insert_ret_annotation(pyi_sig.ret_type)
+      src_sig.insert_ret_annotation(pyi_sig.ret_type_str)
       inserted_types.append(pyi_sig.ret_type)
     return inserted_types
 
@@ -551,11 +686,12 @@ class FixMergePyi(BaseFix):
     for i, (arg_sig, pyi_arg_sig) in enumerate(
         zip(src_sig.arg_sigs, pyi_sig.arg_sigs)):
       is_first = (i == 0)
-      new_type = clean_clone(pyi_arg_sig.arg_type, True)
+      new_type_str = pyi_arg_sig.arg_type_str
 
-      if new_type:
-        new_type_str = str(new_type).strip()
-        inserted_types.append(new_type)
+      if new_type_str:
+        # Only the names in inserted types are used, so the pyi node can be
+        # recorded as is.
+        inserted_types.append(pyi_arg_sig.arg_type)
       elif self.infer_should_annotate(src_sig, arg_sig, is_first):
         new_type_str = 'Any'
       else:
@@ -563,13 +699,13 @@ class FixMergePyi(BaseFix):
 
       str_arg_types.append(arg_sig.stars + new_type_str)
 
-    ret_type = pyi_sig.ret_type
-    if ret_type:
-      inserted_types.append(ret_type)
+    if pyi_sig.ret_type:
+      inserted_types.append(pyi_sig.ret_type)
+      ret_type = pyi_sig.ret_type_str
     else:
       ret_type = self.infer_ret_type(src_sig)
 
-    annot = '(' + ', '.join(str_arg_types) + ') -> ' + str(ret_type).strip()
+    annot = '(' + ', '.join(str_arg_types) + ') -> ' + ret_type
     if src_sig.try_insert_comment_annotation(annot):
       if 'Any' in annot:
         inserted_types.append(Leaf(token.NAME, 'Any'))
@@ -621,19 +757,10 @@ class FixMergePyi(BaseFix):
     Returns:
       True if the two signatures are compatible, False otherwise.
     """
-    if len(pyi_sig.arg_sigs) != len(src_sig.arg_sigs):
-      return False
-
-    for pyi, cur in zip(pyi_sig.arg_sigs, src_sig.arg_sigs):
-      # Entirely skip functions that use tuple args
-      if cur.is_tuple or pyi.is_tuple:
-        return False
-
-      # Stars are expected to match
-      if cur.stars != pyi.stars:
-        return False
-
-    return True
+    # Entirely skip functions that use tuple args. Otherwise, the argument
+    # count and the stars are expected to match.
+    return (src_sig.arg_stars is not None and
+            src_sig.arg_stars == pyi_sig.arg_stars)
 
   @staticmethod
   def infer_ret_type(src_sig):
@@ -646,10 +773,12 @@ class FixMergePyi(BaseFix):
   def infer_should_annotate(func, arg, at_start):
     """Heuristic for whether arg, in func, should be annotated."""
 
-    if func.is_method and at_start and 'staticmethod' not in func.decorators:
+    if at_start and func.is_method:
+      decorators = func.decorators
       # Don't annotate the first argument if it's named 'self'.
       # Don't annotate the first argument of a class method.
-      if arg.name == 'self' or 'classmethod' in func.decorators:
+      if 'staticmethod' not in decorators and (
+          arg.name == 'self' or 'classmethod' in decorators):
         return False
 
     return True
@@ -657,22 +786,31 @@ class FixMergePyi(BaseFix):
   def set_pyi_funcs(self, pyi_funcs):
     """Set the annotations the fixer will use."""
     self.pyi_funcs = pyi_funcs
+    self._pyi_short_names = frozenset(
+        name.rpartition('.')[2] for name in pyi_funcs)
 
 
-class Pyi(collections.namedtuple('Pyi', 'imports assignments funcs')):
+class Pyi(collections.namedtuple(
+    'Pyi', 'imports assignments assignment_names funcs')):
   """A parsed pyi."""
 
-  def _get_imports(self, inserted_types):
-    """Get the imports that provide the given types."""
-    used_names = set()
-    for node in inserted_types + self.assignments:
+  @staticmethod
+  def _add_names(nodes, names):
+    """Add the names used in nodes to the set names."""
+    for node in nodes:
       for leaf in node.leaves():
         if leaf.type == token.NAME:
-          used_names.add(leaf.value)
+          value = leaf.value
+          names.add(value)
           # All prefixes are possible imports.
-          while '.' in leaf.value:
-            value, _ = leaf.rsplit('.', 1)
-            used_names.add(value)
+          while '.' in value:
+            value = value.rpartition('.')[0]
+            names.add(value)
+
+  def _get_imports(self, inserted_types):
+    """Get the imports that provide the given types."""
+    used_names = set(self.assignment_names)
+    self._add_names(inserted_types, used_names)
     for (pkg, pkg_alias), names in self.imports:
       if not names:
         if (pkg_alias or pkg) in used_names:
@@ -689,37 +827,46 @@ class Pyi(collections.namedtuple('Pyi', 'imports assignments funcs')):
     top_lines = []
     def import_name(name, alias):
       return name + ('' if alias is None else ' as %s' % alias)
+    # does_tree_import() searches the module for a binding of the name (or an
+    # import from the package). Such a binding always contains the first
+    # component of the name or package, so names that appear nowhere in the
+    # tree are ruled out without the search.
+    tree_names = {
+        leaf.value for leaf in tree.leaves() if leaf.type == token.NAME}
+    def is_imported(pkg, name):
+      head = (pkg or name).partition('.')[0]
+      # A relative package has an empty head and always needs the search.
+      if head and head not in tree_names:
+        return False
+      return does_tree_import(pkg, name, tree)
     for (pkg, pkg_alias), names in self._get_imports(inserted_types):
       if not names:
-        if does_tree_import(None, pkg_alias or pkg, tree):
+        if is_imported(None, pkg_alias or pkg):
           continue
         top_lines.append('import %s\n' % import_name(pkg, pkg_alias))
       else:
         assert pkg_alias is None
         import_names = []
         for name, alias in names:
-          if does_tree_import(pkg, alias or name, tree):
+          if is_imported(pkg, alias or name):
             continue
           import_names.append(import_name(name, alias))
         if not import_names:
           continue
         top_lines.append('from %s import %s\n' % (pkg, ', '.join(import_names)))
 
-    import_idx = [
-        idx for idx, idx_node in enumerate(tree.children)
-        if self.import_pattern.match(idx_node)
-    ]
-    if import_idx:
-      insert_pos = import_idx[-1] + 1
-    else:
-      insert_pos = 0
-
-      # first string (normally docstring)
-      for idx, idx_node in enumerate(tree.children):
-        if (idx_node.type == syms.simple_stmt and idx_node.children and
+    # Insert after the last import, or else after the first string (normally
+    # the docstring), or else at the top.
+    import_pos = docstring_pos = None
+    for idx, idx_node in enumerate(tree.children):
+      if idx_node.type != syms.simple_stmt:
+        continue
+      if self.import_pattern.match(idx_node):
+        import_pos = idx + 1
+      elif (docstring_pos is None and idx_node.children and
             idx_node.children[0].type == token.STRING):
-          insert_pos = idx + 1
-          break
+        docstring_pos = idx + 1
+    insert_pos = import_pos or docstring_pos or 0
 
     if self.assignments:
       top_lines.append('\n')
@@ -739,8 +886,10 @@ class Pyi(collections.namedtuple('Pyi', 'imports assignments funcs')):
     tree = Util.parse_string(text)
 
     funcs = {}
-    for node, match_results in generate_matches(tree, cls.function_pattern):
-      sig = FuncSignature(node, match_results)
+    key_cache = {}
+    for node, match_results in generate_matches(
+        tree, cls.function_pattern, cls._FUNCTION_TYPES):
+      sig = FuncSignature(node, match_results, key_cache)
 
       if sig.full_name in funcs:
         cls._log_warning('Ignoring redefinition: %s', sig)
@@ -751,7 +900,8 @@ class Pyi(collections.namedtuple('Pyi', 'imports assignments funcs')):
     # Any is sometimes inserted as a default type, so make sure typing.Any is
     # always importable.
     any_import = False
-    for node, match_results in generate_top_matches(tree, cls.import_pattern):
+    for node, match_results in generate_top_matches(
+        tree, cls.import_pattern, cls._STMT_TYPES):
       pkg, names = cls.parse_top_import(match_results)
       if pkg == ('typing', None) and names:
         if ('Any', None) not in names:
@@ -762,7 +912,8 @@ class Pyi(collections.namedtuple('Pyi', 'imports assignments funcs')):
       imports.append((('typing', None), [('Any', None)]))
 
     assignments = []
-    for node, match_results in generate_top_matches(tree, cls.assign_pattern):
+    for node, match_results in generate_top_matches(
+        tree, cls.assign_pattern, cls._STMT_TYPES):
       text = str(node)
 
       # hack to avoid shadowing real variables -- proper solution is more
@@ -772,10 +923,19 @@ class Pyi(collections.namedtuple('Pyi', 'imports assignments funcs')):
       else:
         cls._log_warning('ignoring %s', repr(text))
 
-    return cls(tuple(imports), tuple(assignments), funcs)
+    assignment_names = set()
+    cls._add_names(assignments, assignment_names)
+
+    return cls(tuple(imports), tuple(assignments),
+               frozenset(assignment_names), funcs)
 
   function_pattern = compile_pattern(FuncSignature.PATTERN)
 
+  # The node types matched by function_pattern and by assign_pattern and
+  # import_pattern, respectively.
+  _FUNCTION_TYPES = frozenset({syms.funcdef})
+  _STMT_TYPES = frozenset({syms.simple_stmt})
+
   assign_pattern = compile_pattern("""
     simple_stmt< expr_stmt<any+> any* >
     """)
@@ -843,42 +1003,46 @@ class Pyi(collections.namedtuple('Pyi', 'imports assignments funcs')):
     return pkg_out, names_out
 
 
-class StandaloneRefactoringTool(refactor.RefactoringTool):
-  """Modified RefactoringTool for running outside the standard 2to3 install."""
-
-  def __init__(self, options):
-    self._fixer = None
-    super().__init__([], options=options)
-
-  def get_fixers(self):
-    if self.fixer.order == 'pre':
-      return [self.fixer], []
-    else:
-      return [], [self.fixer]
-
-  @property
-  def fixer(self):
-    if not self._fixer:
-      self._fixer = FixMergePyi(self.options, self.fixer_log)
-    return self._fixer
-
-
 def is_top_level(node):
   """Is node at top indentation level (i.e. module globals)?"""
   return bool(len(find_indentation(node)))
 
 
-def generate_matches(tree, pattern):
-  """Generator yielding nodes in tree that match pattern."""
+def generate_matches(tree, pattern, node_types=None):
+  """Generator yielding nodes in tree that match pattern.
+
+  Args:
+    tree: The root of the tree to search.
+    pattern: A compiled pattern.
+    node_types: Optionally, a set of the node types pattern can match. Nodes of
+      other types are skipped without running the pattern.
+
+  Yields:
+    (node, match results) pairs.
+  """
   for node in tree.pre_order():
+    if node_types is not None and node.type not in node_types:
+      continue
     results = {}
     if pattern.match(node, results):
       yield node, results
 
 
-def generate_top_matches(node, pattern):
-  """Generator yielding direct children of node that match pattern."""
+def generate_top_matches(node, pattern, node_types=None):
+  """Generator yielding direct children of node that match pattern.
+
+  Args:
+    node: The node whose children are searched.
+    pattern: A compiled pattern.
+    node_types: Optionally, a set of the node types pattern can match. Nodes of
+      other types are skipped without running the pattern.
+
+  Yields:
+    (node, match results) pairs.
+  """
   for child in node.children:
+    if node_types is not None and child.type not in node_types:
+      continue
     results = {}
     if pattern.match(child, results):
       yield child, results
@@ -889,19 +1053,14 @@ def clean_clone(node, strip_formatting):
   if not node:
     return None
 
+  node = node.clone()
   if strip_formatting:
-    # strip formatting and comments, represent as prettyfied string
-    # For comment-style annotations, important to have a single line
-    s = ''.join(
-        ', ' if token.COMMA == n.type else n.value for n in node.leaves())
-    assert s
-
-    # parse back into a Node
-    node = Util.parse_string(s)
-    assert len(node.children) == 2
-    node = node.children[0]
-  else:
-    node = node.clone()
+    # strip formatting and comments, which live in the prefixes, so that the
+    # node prints as a single line with a space after each comma
+    after_comma = False
+    for leaf in node.leaves():
+      leaf.prefix = ' ' if after_comma else ''
+      after_comma = leaf.type == token.COMMA
 
   node.parent = None
 
@@ -910,27 +1069,164 @@ def clean_clone(node, strip_formatting):
 
 def split_comma(nodes):
   """Take iterable of nodes, return list of lists of nodes."""
+  groups = []
+  group = []
+  for n in nodes:
+    if n.type == token.COMMA:
+      if group:
+        groups.append(group)
+        group = []
+    else:
+      group.append(n)
+  if group:
+    groups.append(group)
+  return groups
+
+
+def get_top_level_spans(tree, src):
+  """Get the source offsets of the top-level statements of a fresh tree.
+
+  Args:
+    tree: The tree parsed from src, before any modifications.
+    src: The source code.
+
+  Returns:
+    A dict mapping id(child) to (child, start, end) for each child of tree,
+    where src[start:end] == str(child).
+  """
+  line_starts = [0]
+  pos = src.find('\n')
+  while pos != -1:
+    line_starts.append(pos + 1)
+    pos = src.find('\n', pos + 1)
+  starts = []
+  for child in tree.children:
+    leaf = child if isinstance(child, Leaf) else next(child.leaves())
+    starts.append(
+        line_starts[leaf.lineno - 1] + leaf.column - len(leaf.prefix))
+  ends = starts[1:] + [len(src)]
+  return {id(child): (child, start, end)
+          for child, start, end in zip(tree.children, starts, ends)}
+
+
+def tree_to_string(tree, src, spans):
+  """Like str(tree), but copies unchanged top-level statements from src.
+
+  Args:
+    tree: A tree parsed from src, possibly modified since.
+    src: The source code.
+    spans: The result of get_top_level_spans() on the unmodified tree.
+
+  Returns:
+    The source code of tree.
+  """
+  parts = []
+  for child in tree.children:
+    span = spans.get(id(child))
+    if span and span[0] is child and not child.was_changed:
+      parts.append(src[span[1]:span[2]])
+    else:
+      parts.append(str(child))
+  return ''.join(parts)
 
-  def is_comma(n):
-    return token.COMMA == n.type
 
-  groups = itertools.groupby(nodes, is_comma)
-  return [list(group) for comma, group in groups if not comma]
+def function_keys(src):
+  """Returns the FuncSignature.full_name of every function in src.
+
+  This uses the builtin ast module, which is much faster than lib2to3.
+
+  Args:
+    src: Python source code.
+
+  Returns:
+    A set of function keys, or None if src could not be parsed.
+  """
+  try:
+    tree = ast.parse(src)
+  except (SyntaxError, ValueError):
+    return None
+  keys = set()
+  stack = [(tree, '')]
+  while stack:
+    node, prefix = stack.pop()
+    for child in ast.iter_child_nodes(node):
+      if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        keys.add(prefix + child.name)
+        stack.append((child, prefix + child.name + '.'))
+      elif isinstance(child, ast.ClassDef):
+        stack.append((child, prefix + child.name + '.'))
+      else:
+        stack.append((child, prefix))
+  return keys
 
 
 def annotate_string(args, py_src, pyi_src):
   """Applies the annotations in pyi_src to py_src."""
 
-  tool = StandaloneRefactoringTool(options={'print_function': True})
-  fixer = tool.fixer
+  parsed_pyi = Pyi.parse(pyi_src)
+  # The fixer logs a warning for every function it skips, so only take the
+  # shortcut when those warnings would not be shown.
+  if (not parsed_pyi.assignments and not logging.getLogger(
+      FixMergePyi.__name__).isEnabledFor(logging.WARNING)):
+    py_keys = function_keys(py_src)
+    if py_keys is not None and py_keys.isdisjoint(parsed_pyi.funcs):
+      # Nothing would be inserted, so skip the lib2to3 round trip of py_src.
+      return py_src
+
+  fixer = FixMergePyi({'print_function': True}, [])
 
   fixer.annotate_pep484 = not args.as_comments
-  parsed_pyi = Pyi.parse(pyi_src)
   fixer.set_pyi_funcs(parsed_pyi.funcs)
 
-  tree = tool.refactor_string(py_src + '\n', '<inline>')
+  # We have a single fixer that only edits the functions it matches, so apply
+  # it directly instead of through a lib2to3 RefactoringTool. The matches are
+  # collected first because transform() modifies the tree.
+  src = py_src + '\n'
+  tree = Util.driver.parse_string(src)
+  spans = get_top_level_spans(tree, src)
+  fixer.start_tree(tree, '<inline>')
+  matches = []
+  for node in tree.pre_order():
+    if node.type == syms.funcdef:
+      results = fixer.match(node)
+      if results:
+        matches.append((node, results))
+  for node, results in matches:
+    fixer.transform(node, results)
+  fixer.finish_tree(tree, '<inline>')
   parsed_pyi.add_globals(tree, tuple(fixer.inserted_types))
 
-  annotated_src = str(tree)[:-1]
+  annotated_src = tree_to_string(tree, src, spans)[:-1]
 
   return annotated_src
+
+
+def _annotate_pair(as_comments, py_src, pyi_src):
+  return annotate_string(
+      types.SimpleNamespace(as_comments=as_comments), py_src, pyi_src)
+
+
+def annotate_strings(args, srcs, max_workers=None):
+  """Applies annotate_string to many sources in parallel.
+
+  Each (py_src, pyi_src) pair is independent, so the pairs are split between
+  worker processes.
+
+  Args:
+    args: The options for annotate_string. Only args.as_comments is used, so
+      args itself need not be picklable.
+    srcs: A sequence of (py_src, pyi_src) pairs.
+    max_workers: The number of worker processes; defaults to the CPU count.
+
+  Returns:
+    The annotated sources, in the order of srcs.
+  """
+  if not srcs:
+    return []
+  num_workers = max_workers or os.cpu_count() or 1
+  chunksize = max(1, len(srcs) // (4 * num_workers))
+  py_srcs, pyi_srcs = zip(*srcs)
+  with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+    return list(executor.map(
+        functools.partial(_annotate_pair, bool(args.as_comments)),
+        py_srcs, pyi_srcs, chunksize=chunksize))
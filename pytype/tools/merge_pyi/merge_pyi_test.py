@@ -100,6 +100,52 @@ def build_regression_test(args, py, pyi, outfile):
   return case(test)
 
 
+class AnnotateStringTest(unittest.TestCase):
+  """Tests for annotate_string with sources that have nothing to merge."""
+
+  PY_SRC = 'def q(x):\n  return x\n\ndef r(y: int):\n  return y\n'
+  PYI_SRC = 'def s(z: int) -> int: ...\n'
+
+  def test_skipped_functions_are_logged(self):
+    with self.assertLogs('FixMergePyi', logging.WARNING) as logs:
+      output = merge_pyi.annotate_string(Args(), self.PY_SRC, self.PYI_SRC)
+    self.assertEqual(self.PY_SRC, output)
+    self.assertEqual([
+        'WARNING:FixMergePyi:no signature for q, skipping',
+        'WARNING:FixMergePyi:already annotated, skipping r',
+    ], logs.output)
+
+  def test_warnings_disabled(self):
+    logger = logging.getLogger('FixMergePyi')
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    try:
+      output = merge_pyi.annotate_string(Args(), self.PY_SRC, self.PYI_SRC)
+    finally:
+      logger.setLevel(level)
+    self.assertEqual(self.PY_SRC, output)
+
+
+class AnnotateStringsTest(unittest.TestCase):
+  """Tests for annotate_strings."""
+
+  def test_matches_annotate_string(self):
+    data_dir = os.path.join(os.path.dirname(__file__), 'test_data')
+    files_by_base = TestBuilder()._get_files_by_base(data_dir)  # pylint: disable=protected-access
+    args = Args(as_comments=1)
+    srcs = []
+    for _, files_by_ext in sorted(files_by_base.items()):
+      if all(ext in files_by_ext for ext in (PY, PYI, args.expected_ext)):
+        srcs.append((_read_file(files_by_ext[PY]),
+                     _read_file(files_by_ext[PYI])))
+    expected = [merge_pyi.annotate_string(args, py, pyi) for py, pyi in srcs]
+    self.assertEqual(
+        expected, merge_pyi.annotate_strings(args, srcs, max_workers=2))
+
+  def test_empty(self):
+    self.assertEqual([], merge_pyi.annotate_strings(Args(), []))
+
+
 def _read_file(filename):
   with open(filename) as f:
     return f.read()